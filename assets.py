@@ -0,0 +1,225 @@
+import os
+import re
+import sys
+import gzip
+import posixpath
+import hashlib
+import mimetypes
+from io import BytesIO
+
+from flask import request, abort
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+## Precompressed, cache-validated serving of the files under public/.
+##
+## Every file is read once at startup, hashed for a strong ETag and, for text types,
+## compressed with gzip and (if the brotli package is installed) brotli. Compressed
+## variants are kept in a cache directory keyed by content hash, so only changed files
+## are recompressed on restart. `python assets.py` fills the cache at build time with
+## brotli at BROTLI_QUALITY, which takes seconds; a server starting on a cache without
+## them compresses at RUNTIME_BROTLI_QUALITY instead and doesn't store the result.
+## Requests are answered from memory with the best variant the client accepts, and a
+## matching If-None-Match gets a 304 without touching the file system.
+##
+## A URL carrying ?v=<etag> (see AssetStore.url) is sent as immutable for a year. The
+## HTML pages are loaded with their src/href references to other files under public/
+## rewritten to such URLs, so a page load fetches scripts and stylesheets from cache
+## without revalidating them, and a changed file gets a new URL. Everything requested
+## without the current ?v= (the pages themselves, images referenced from CSS) is
+## revalidated on each use, which costs a 304 once the browser has a copy.
+
+COMPRESSIBLE_TYPES = ["text/", "application/javascript", "application/json", "application/x-javascript", "image/svg+xml"]
+IMMUTABLE_CACHE = "public, max-age=31536000, immutable"
+REVALIDATE_CACHE = "no-cache"
+MIN_COMPRESS_BYTES = 512
+BROTLI_QUALITY = 11
+RUNTIME_BROTLI_QUALITY = 5
+# relative src/href references in the pages, without query or fragment
+REFERENCE_PATTERN = re.compile(r'(\s(?:src|href)=")([^"?#:]+)(")')
+DEFAULT_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".asset-cache")
+
+mimetypes.add_type("application/json", ".map")
+
+
+def gzip_bytes(content):
+    buffer = BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode="wb", compresslevel=9, mtime=0) as f:
+        f.write(content)
+    return buffer.getvalue()
+
+
+def accepted_encodings(header):
+    accepted = {}
+    for part in header.split(","):
+        fields = part.strip().split(";")
+        name = fields[0].strip().lower()
+        q = 1.
+        for field in fields[1:]:
+            field = field.strip()
+            if field.startswith("q="):
+                try:
+                    q = float(field[2:])
+                except ValueError:
+                    q = 0.
+        if name != "":
+            accepted[name] = q
+    return accepted
+
+
+def brotli_bytes(content, quality=BROTLI_QUALITY):
+    return brotli.compress(content, quality=quality)
+
+
+# (encoding, encoder, quicker encoder for cache misses outside of builds or None)
+ENCODERS = [("gzip", gzip_bytes, None)]
+if brotli is not None:
+    ENCODERS.append(("br", brotli_bytes, lambda content: brotli_bytes(content, RUNTIME_BROTLI_QUALITY)))
+
+
+class Asset(object):
+
+    def __init__(self, path, content, cache_dir=None, build=False):
+        self.path = path
+        self.etag = hashlib.sha1(content).hexdigest()[:20]
+        self.mimetype = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        self.variants = {"identity": content}
+
+        if len(content) >= MIN_COMPRESS_BYTES and self.compressible():
+            for encoding, encode, quick in ENCODERS:
+                compressed = self.cached(cache_dir, encoding)
+                if compressed is None and quick is not None and not build:
+                    # not stored, the cache only keeps what a build compressed
+                    compressed = quick(content)
+                elif compressed is None:
+                    compressed = encode(content)
+                    self.store(cache_dir, encoding, compressed)
+                if len(compressed) < len(content):
+                    self.variants[encoding] = compressed
+
+    def cache_path(self, cache_dir, encoding):
+        return os.path.join(cache_dir, self.etag + "." + encoding)
+
+    def cached(self, cache_dir, encoding):
+        if cache_dir is None or not os.path.isfile(self.cache_path(cache_dir, encoding)):
+            return None
+        with open(self.cache_path(cache_dir, encoding), "rb") as f:
+            return f.read()
+
+    def store(self, cache_dir, encoding, compressed):
+        if cache_dir is not None:
+            with open(self.cache_path(cache_dir, encoding), "wb") as f:
+                f.write(compressed)
+
+    def compressible(self):
+        for prefix in COMPRESSIBLE_TYPES:
+            if self.mimetype.startswith(prefix):
+                return True
+        return False
+
+    def choose(self, accept_encoding):
+        accepted = accepted_encodings(accept_encoding)
+        best = "identity"
+        for encoding in ["br", "gzip"]:
+            if encoding in self.variants and accepted.get(encoding, accepted.get("*", 0.)) > 0.:
+                if best == "identity" or len(self.variants[encoding]) < len(self.variants[best]):
+                    best = encoding
+        return best
+
+
+def is_page(path):
+    return path.endswith(".html")
+
+
+def versioned(page, content, assets):
+    """`content` of `page` with its references to `assets` carrying ?v=<etag>."""
+    def link(match):
+        target = posixpath.normpath(posixpath.join(posixpath.dirname(page), match.group(2)))
+        asset = assets.get(target)
+        if asset is None:
+            return match.group(0)
+        return match.group(1) + match.group(2) + "?v=" + asset.etag + match.group(3)
+
+    return REFERENCE_PATTERN.sub(link, content)
+
+
+class AssetStore(object):
+    """In-memory copy of a static directory with its compressed variants."""
+
+    def __init__(self, root, cache_dir=DEFAULT_CACHE_DIR, build=False):
+        self.root = root
+        self.cache_dir = cache_dir
+        self.build = build
+        self.assets = {}
+        self.load()
+
+    def load(self):
+        if self.cache_dir is not None and not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+        contents = {}
+        for directory, subdirs, files in os.walk(self.root):
+            for name in files:
+                if name.startswith("."):
+                    continue
+                full = os.path.join(directory, name)
+                path = os.path.relpath(full, self.root).replace(os.sep, "/")
+                with open(full, "rb") as f:
+                    contents[path] = f.read()
+
+        assets = {}
+        for path, content in contents.items():
+            if not is_page(path):
+                assets[path] = Asset(path, content, self.cache_dir, self.build)
+        # pages last: they link the other files by their ETags
+        for path, content in contents.items():
+            if is_page(path):
+                assets[path] = Asset(path, versioned(path, content, assets), self.cache_dir, self.build)
+        self.assets = assets
+
+    def url(self, path):
+        # cache-busted URL that can be served as immutable
+        return path + "?v=" + self.assets[path].etag
+
+    def send(self, app, path):
+        asset = self.assets.get(path)
+        if asset is None:
+            abort(404)
+
+        etag = '"' + asset.etag + '"'
+        if request.args.get("v") == asset.etag:
+            cache_control = IMMUTABLE_CACHE
+        else:
+            cache_control = REVALIDATE_CACHE
+
+        headers = {
+            "ETag": etag,
+            "Cache-Control": cache_control,
+            "Vary": "Accept-Encoding"
+        }
+
+        if_none_match = request.headers.get("If-None-Match", "")
+        if if_none_match.strip() == "*" or etag in [t.strip().replace("W/", "") for t in if_none_match.split(",")]:
+            return app.response_class(status=304, headers=headers)
+
+        encoding = asset.choose(request.headers.get("Accept-Encoding", ""))
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+
+        return app.response_class(asset.variants[encoding], mimetype=asset.mimetype, headers=headers)
+
+    def summary(self):
+        total = {"files": len(self.assets), "identity": 0, "gzip": 0, "br": 0}
+        for asset in self.assets.values():
+            for encoding in ["identity", "gzip", "br"]:
+                total[encoding] += len(asset.variants.get(encoding, asset.variants["identity"]))
+        return total
+
+
+## precompress everything at build time
+if __name__ == "__main__":
+    store = AssetStore(sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(os.path.abspath(__file__)), "public"), build=True)
+    print(store.summary())
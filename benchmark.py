@@ -0,0 +1,282 @@
+import sys
+import os
+import gc
+import json
+import time
+import random
+import resource
+import argparse
+import subprocess
+from datetime import datetime, timedelta
+
+from scipy.cluster import hierarchy
+from scipy.spatial import distance
+
+import encoding
+import snapshots
+
+## Benchmark suite for the server hot paths.
+##
+## Generates synthetic flights-like and permits-like collections, loads them into an
+## in-memory Mongo stand-in (mongomock) and times startup plus the Flask endpoints
+## through the test client. Results are printed (or written) as JSON, one record per
+## dataset size, so runs on different commits can be diffed.
+##
+## Each size runs in its own process. Memory is the process high-water mark (ru_maxrss):
+## a stage's rss_high_water_kb is the peak so far, not what that stage allocated, so it
+## never goes down from one stage to the next; the record's peak_rss_kb is the peak of
+## the whole run.
+##
+##   python benchmark.py --dataset flights --rows 10000,100000 --output bench.json
+
+DEFAULT_ROWS = [10000]
+DEFAULT_SELECTION = 1000
+DEFAULT_LINKAGE_ROWS = 2000
+
+ANNOTATION_TEMPLATES = [
+    "system issues due to a power outage at the operations center",
+    "security issues caused by understaffed TSA at the checkpoints",
+    "airline glitches due to lack of coordination and maintenance problems",
+    "late aircraft due to fueling and late arrival from a previous trip",
+    "extreme weather such as tornado, hurricane, or blizzard",
+]
+
+
+def peak_rss_kb():
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS and kilobytes on Linux
+    if sys.platform == "darwin":
+        return usage / 1024
+    return usage
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"],
+                                       stderr=subprocess.STDOUT).strip().decode("ascii")
+    except Exception:
+        return None
+
+
+## synthetic data generation
+
+def make_annotations(count):
+    annotations = []
+    for i in range(0, count):
+        annotations.append("Delay caused by " + ANNOTATION_TEMPLATES[i % len(ANNOTATION_TEMPLATES)] + " #" + str(i))
+    return annotations
+
+
+def generate_flights(rows, cardinality=50, annotations=20, annotated=0.3, seed=0):
+    rng = random.Random(seed)
+    cities = ["City " + str(i) + ", ST" for i in range(0, cardinality)]
+    reasons = make_annotations(annotations)
+
+    documents = []
+    for index in range(0, rows):
+        document = {}
+        document["origin"] = rng.choice(cities)
+        document["destination"] = rng.choice(cities)
+        document["origin_state"] = document["origin"][-2:]
+        document["destination_state"] = document["destination"][-2:]
+        document["flight"] = "DL" + str(rng.randint(1, 3000))
+        document["dep_delay"] = int(10 * round(rng.gauss(10, 30) / 10))
+        document["arr_delay"] = int(10 * round(rng.gauss(5, 35) / 10))
+        document["distance"] = int(100 * round(rng.uniform(1000, 5000) / 100))
+        document["reason"] = [rng.choice(reasons)] if rng.random() < annotated else []
+        document["index"] = index
+        documents.append(document)
+
+    return documents
+
+
+def generate_permits(rows, cardinality=50, annotations=20, annotated=0.3, seed=0):
+    rng = random.Random(seed)
+    descriptions = ["Description " + str(i) for i in range(0, cardinality)]
+    subtypes = ["Subtype " + str(i) for i in range(0, max(1, cardinality // 5))]
+    contacts = ["Contractor " + str(i) for i in range(0, cardinality * 4)]
+    purposes = ["Purpose " + str(i) for i in range(0, annotations)]
+    start = datetime(2010, 1, 1)
+
+    documents = []
+    for index in range(0, rows):
+        document = {}
+        document["date"] = start + timedelta(seconds=rng.randint(0, 8 * 365 * 24 * 3600))
+        document["description"] = rng.choice(descriptions)
+        document["subtype"] = rng.choice(subtypes)
+        document["contact"] = rng.choice(contacts)
+        document["latitude"] = rng.uniform(37.7, 37.8)
+        document["longitude"] = rng.uniform(-122.5, -122.4)
+        document["zip"] = str(rng.randint(94100, 94199))
+        # free-text purpose, "None" where the permit has none (as in mongo_insert_building.py)
+        document["purpose"] = rng.choice(purposes) if rng.random() < annotated else "None"
+        documents.append(document)
+
+    return documents
+
+
+def make_collection(documents):
+    import mongomock
+
+    collection = mongomock.MongoClient().benchmark.data
+    collection.insert_many(documents)
+    return collection
+
+
+def use_collection(dataset, documents):
+    """Points `dataset` at an in-memory collection of `documents`, without caches or snapshots on disk."""
+    dataset.collection = make_collection(documents)
+    dataset.meta_cache = None
+    dataset.columns_dir = None
+    dataset.meta.clear()
+    dataset.unload()
+    return dataset
+
+
+## timing helpers
+
+def timed(results, name, fn, *args, **kwargs):
+    gc.collect()
+    start = time.time()
+    value = fn(*args, **kwargs)
+    results[name] = {
+        "seconds": time.time() - start,
+        "rss_high_water_kb": peak_rss_kb()
+    }
+    return value
+
+
+def timed_post(results, name, client, url, payload):
+    gc.collect()
+    start = time.time()
+    response = client.post(url, data=json.dumps(payload), content_type="application/json")
+    body = response.get_data()
+    results[name] = {
+        "seconds": time.time() - start,
+        "rss_high_water_kb": peak_rss_kb(),
+        "status": response.status_code,
+        "bytes": len(body)
+    }
+    return response
+
+
+## per-dataset runners
+
+def run_flights(args, rows):
+    import app_flights as app_module
+
+    documents = generate_flights(rows, args.cardinality, args.annotations, args.annotated, args.seed)
+    dataset = use_collection(app_module.dataset, documents)
+
+    results = {}
+    data, features = timed(results, "create_feature_vectors", dataset.create_feature_vectors, {})
+    distributions = timed(results, "find_annotation_distributions", dataset.find_annotation_distributions, {})
+
+    sample = features[:min(len(features), args.linkage_rows)]
+    condensed = encoding.pdist(sample, "cosine")
+    clusters = timed(results, "linkage", hierarchy.linkage, condensed, metric="cosine", method="average")
+    dataset.snapshot = snapshots.Snapshot(data=data, features=features, distributions=distributions, meta=dataset.meta)
+    # /clusters cuts this linkage of the first rows instead of one over all of them
+    dataset.snapshot.derive("clusters", lambda s: (distance.squareform(condensed), clusters))
+
+    rng = random.Random(args.seed)
+    selection = sorted(rng.sample(range(0, rows), min(rows, args.selection)))
+    request = {"indices": selection, "focus": None, "measure": "euclidean", "cols": ["origin"]}
+
+    client = app_module.app.test_client()
+    timed_post(results, "/data", client, "/data", {})
+    timed_post(results, "/distance", client, "/distance", request)
+    timed_post(results, "/order", client, "/order", request)
+    timed_post(results, "/clusters", client, "/clusters", {"cols": ["origin"], "filters": {}})
+
+    return results
+
+
+def run_building(args, rows):
+    import app_building as app_module
+
+    documents = generate_permits(rows, args.cardinality, args.annotations, args.annotated, args.seed)
+    dataset = use_collection(app_module.dataset, documents)
+
+    results = {}
+    data, features = timed(results, "create_feature_vectors", dataset.create_feature_vectors, {})
+
+    sample = features[:min(len(features), args.linkage_rows)]
+    condensed = encoding.pdist(sample, "cosine")
+    clusters = timed(results, "linkage", hierarchy.linkage, condensed, metric="cosine", method="average")
+    dataset.snapshot = snapshots.Snapshot(data=data, features=features, distributions={}, meta=dataset.meta)
+    # /annotation cuts this linkage of the first rows instead of one over all of them
+    dataset.snapshot.derive("clusters", lambda s: (distance.squareform(condensed), clusters))
+
+    client = app_module.app.test_client()
+    timed_post(results, "/data", client, "/data", {})
+    timed_post(results, "/annotation", client, "/annotation", {"cols": ["description"], "filters": {}})
+
+    return results
+
+
+RUNNERS = {
+    "flights": run_flights,
+    "building": run_building
+}
+
+
+def run_single(args, rows):
+    record = {
+        "dataset": args.dataset,
+        "rows": rows,
+        "cardinality": args.cardinality,
+        "annotations": args.annotations,
+        "annotated": args.annotated,
+        "selection": args.selection,
+        "revision": git_revision(),
+        "timestamp": datetime.utcnow().isoformat()
+    }
+    record["stages"] = RUNNERS[args.dataset](args, rows)
+    record["peak_rss_kb"] = peak_rss_kb()
+    return record
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Benchmark the annotation exploration server.")
+    parser.add_argument("--dataset", choices=sorted(RUNNERS.keys()), default="flights")
+    parser.add_argument("--rows", default=",".join(str(r) for r in DEFAULT_ROWS),
+                        help="comma separated dataset sizes, e.g. 10000,100000,1000000")
+    parser.add_argument("--cardinality", type=int, default=50, help="distinct values per categorical column")
+    parser.add_argument("--annotations", type=int, default=20, help="distinct annotation strings")
+    parser.add_argument("--annotated", type=float, default=0.3, help="fraction of rows carrying an annotation")
+    parser.add_argument("--selection", type=int, default=DEFAULT_SELECTION, help="indices sent to /distance and /order")
+    parser.add_argument("--linkage-rows", type=int, default=DEFAULT_LINKAGE_ROWS, help="rows used for the linkage stage")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="write JSON results to this file instead of stdout")
+    parser.add_argument("--single", action="store_true", help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = parse_args(argv)
+    sizes = [int(r) for r in args.rows.split(",") if r.strip() != ""]
+
+    if args.single:
+        print(json.dumps(run_single(args, sizes[0])))
+        return
+
+    # every size runs in a fresh process so peak memory figures do not bleed across runs
+    records = []
+    for rows in sizes:
+        child = [sys.executable, os.path.abspath(__file__), "--single", "--rows", str(rows)]
+        for name in ["dataset", "cardinality", "annotations", "annotated", "selection", "linkage_rows", "seed"]:
+            child.extend(["--" + name.replace("_", "-"), str(getattr(args, name))])
+        output = subprocess.check_output(child)
+        records.append(json.loads(output.decode("utf-8").strip().splitlines()[-1]))
+
+    result = json.dumps(records, indent=2, sort_keys=True)
+    if args.output is None:
+        print(result)
+    else:
+        with open(args.output, "w") as f:
+            f.write(result)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,79 @@
+import os
+import json
+import time
+import threading
+from timeit import default_timer as timer
+
+from flask import g, request
+
+## Opt-in capture of dashboard traffic for replay.py.
+##
+## When CAPTURE_FILE is set (app config, or the CAPTURE_FILE environment variable), every
+## request to one of the CAPTURE_ENDPOINTS (/data, /order, /distance, /clusters,
+## /annotation, also under /<dataset>/) is appended to that file as one JSON line: its
+## arrival time, method, path, body, Accept header, status and latency. replay.py re-issues
+## the requests with their original spacing. Without CAPTURE_FILE the cost is one config
+## lookup per request.
+
+DEFAULT_CONFIG = {
+    "CAPTURE_FILE": os.environ.get("CAPTURE_FILE"),
+    "CAPTURE_ENDPOINTS": ["data", "order", "distance", "clusters", "annotation"]
+}
+
+_lock = threading.Lock()
+
+
+def _wants_capture(app):
+    if app.config["CAPTURE_FILE"] is None or request.url_rule is None:
+        return False
+    return request.url_rule.rule.rstrip("/").split("/")[-1] in app.config["CAPTURE_ENDPOINTS"]
+
+
+def record(path, entry):
+    line = json.dumps(entry, sort_keys=True) + "\n"
+    with _lock:
+        with open(path, "a") as f:
+            f.write(line)
+
+
+def read(path):
+    """Captured requests in arrival order."""
+    entries = []
+    with open(path) as f:
+        for line in f:
+            if line.strip() != "":
+                entries.append(json.loads(line))
+    entries.sort(key=lambda entry: entry["time"])
+    return entries
+
+
+## flask hooks
+
+def init_app(app):
+    for key, value in DEFAULT_CONFIG.items():
+        app.config.setdefault(key, value)
+
+    @app.before_request
+    def start_capture():
+        if not _wants_capture(app):
+            return
+        g.capture_time = time.time()
+        g.capture_start = timer()
+
+    @app.after_request
+    def stop_capture(response):
+        if getattr(g, "capture_start", None) is None:
+            return response
+
+        record(app.config["CAPTURE_FILE"], {
+            "time": g.capture_time,
+            "method": request.method,
+            "path": request.path,
+            "body": request.get_data(as_text=True),
+            "accept": request.headers.get("Accept"),
+            "status": response.status_code,
+            "ms": (timer() - g.capture_start) * 1000.
+        })
+        return response
+
+    return app
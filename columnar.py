@@ -0,0 +1,397 @@
+import os
+import json
+import time
+import shutil
+import numbers
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+import numpy as np
+import bson
+
+import encoding
+
+## Columnar on-disk snapshots of a collection, written at ingest and memory-mapped by
+## the apps at startup.
+##
+## A snapshot directory holds one version per ingest run and a CURRENT file naming the
+## latest one. A version has a manifest (format, row count, schema) and one typed .npy
+## file per column: int64, float64, dates as int64 microseconds since the epoch, ObjectIds
+## as 12 uint8s, other scalars (strings, None, mixed) as int32 codes into a JSON
+## dictionary, and lists (annotations) as offsets plus codes into a dictionary. Columns
+## missing from some documents also get a presence mask. Arrays are opened with
+## mmap_mode="r", so startup does not read them and worker processes share their pages.
+##
+## Table.rows() looks like the list of documents the apps otherwise load from Mongo: each
+## row is decoded into a dict when accessed. Request pipelines use Rows.select() instead,
+## which decodes only the columns they read for all selected rows at once, and
+## Rows.lengths() for annotation presence. Table.encode() builds the feature matrix
+## and Table.meta() the column metadata straight from the arrays, so starting from a
+## snapshot does not touch Mongo at all.
+
+FORMAT = 1
+CURRENT = "CURRENT"
+MANIFEST = "manifest.json"
+KEEP_VERSIONS = 2
+EPOCH = datetime(1970, 1, 1)
+
+try:
+    STRING_TYPES = (str, unicode)
+except NameError:
+    STRING_TYPES = (str,)
+
+
+def value_kind(value):
+    if value is None or isinstance(value, bool) or isinstance(value, STRING_TYPES):
+        return "category"
+    if isinstance(value, numbers.Integral):
+        return "int64"
+    if isinstance(value, numbers.Real):
+        return "float64"
+    if isinstance(value, datetime):
+        return "date"
+    if isinstance(value, bson.ObjectId):
+        return "objectid"
+    if isinstance(value, list):
+        return "list"
+    raise ValueError("Can't store " + repr(value) + " in a columnar snapshot")
+
+
+def column_type(values):
+    kinds = set(value_kind(value) for value in values)
+    if len(kinds) == 1:
+        return kinds.pop()
+    if kinds <= set(["int64", "float64"]):
+        return "float64"
+    if kinds <= set(["int64", "float64", "category"]):
+        return "category"
+    raise ValueError("Mixed column types " + ", ".join(sorted(kinds)))
+
+
+def microseconds(moment):
+    delta = moment - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def as_python(value):
+    return value.item() if isinstance(value, np.generic) else value
+
+
+## writing
+
+def dictionary_codes(values, dictionary, lookup):
+    codes = []
+    for value in values:
+        value = as_python(value)
+        # True, 1 and 1.0 are equal as dict keys but are different values
+        key = value if isinstance(value, STRING_TYPES) else (type(value).__name__, value)
+        if key not in lookup:
+            lookup[key] = len(dictionary)
+            dictionary.append(value)
+        codes.append(lookup[key])
+    return np.array(codes, dtype=np.int32)
+
+
+def write_column(path, number, name, documents):
+    present = np.array([name in document for document in documents], dtype=bool)
+    values = [document[name] for document in documents if name in document]
+    kind = column_type(values)
+    base = "col%d" % number
+    column = {"type": kind, "files": {}, "missing": int(len(documents) - present.sum())}
+
+    def save(suffix, array):
+        np.save(os.path.join(path, base + suffix + ".npy"), array)
+        column["files"][suffix.strip(".") or "values"] = base + suffix + ".npy"
+
+    def fill(default):
+        filled = [default] * len(documents)
+        for position, value in zip(np.flatnonzero(present), values):
+            filled[position] = value
+        return filled
+
+    if kind in ["int64", "float64"]:
+        save("", np.array(fill(0), dtype=kind))
+    elif kind == "date":
+        save("", np.array([microseconds(value) for value in fill(EPOCH)], dtype=np.int64))
+    elif kind == "objectid":
+        binary = b"".join(value.binary for value in fill(bson.ObjectId(b"\0" * 12)))
+        save("", np.frombuffer(binary, dtype=np.uint8).reshape((len(documents), 12)))
+    else:
+        dictionary = []
+        if kind == "list":
+            items = [item for value in values for item in value]
+            save(".offsets", np.concatenate([[0], np.cumsum([len(value) for value in fill([])])]).astype(np.int64))
+            save(".codes", dictionary_codes(items, dictionary, {}))
+        else:
+            save(".codes", dictionary_codes(fill(None), dictionary, {}))
+        column["files"]["dictionary"] = base + ".dictionary.json"
+        with open(os.path.join(path, base + ".dictionary.json"), "w") as f:
+            json.dump(dictionary, f)
+
+    if column["missing"] > 0:
+        save(".present", present)
+    return column
+
+
+def versions(directory):
+    if not os.path.isdir(directory):
+        return []
+    return sorted(name for name in os.listdir(directory) if os.path.isfile(os.path.join(directory, name, MANIFEST)))
+
+
+def write(directory, documents, source=None):
+    """Writes `documents` as a new version under `directory` and makes it CURRENT."""
+    names = OrderedDict()
+    for document in documents:
+        for name in document.keys():
+            names[name] = True
+
+    # numbered so that versions sort in the order they were written
+    numbers = [int(name.split("-")[0]) for name in versions(directory)]
+    version = "%06d-%s" % (max(numbers + [0]) + 1, time.strftime("%Y%m%d-%H%M%S"))
+    target = os.path.join(directory, version)
+    staging = target + ".tmp"
+    os.makedirs(staging)
+
+    manifest = {
+        "format": FORMAT,
+        "version": os.path.basename(target),
+        "source": source,
+        "created": datetime.utcnow().isoformat(),
+        "rows": len(documents),
+        "columns": OrderedDict()
+    }
+    for number, name in enumerate(names.keys()):
+        manifest["columns"][name] = write_column(staging, number, name, documents)
+
+    with open(os.path.join(staging, MANIFEST), "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.rename(staging, target)
+
+    # readers follow CURRENT, which is replaced in one rename
+    with open(os.path.join(directory, CURRENT + ".tmp"), "w") as f:
+        f.write(manifest["version"] + "\n")
+    os.rename(os.path.join(directory, CURRENT + ".tmp"), os.path.join(directory, CURRENT))
+
+    # mapped files of removed versions stay readable for processes still using them
+    for name in versions(directory)[:-KEEP_VERSIONS]:
+        shutil.rmtree(os.path.join(directory, name))
+
+    return target
+
+
+## reading
+
+class Column(object):
+
+    def __init__(self, path, spec):
+        self.type = spec["type"]
+        self.arrays = dict((key, np.load(os.path.join(path, name), mmap_mode="r"))
+                           for key, name in spec["files"].items() if name.endswith(".npy"))
+        self.present = self.arrays.get("present")
+        self._lengths = None
+        self.dictionary = None
+        if "dictionary" in spec["files"]:
+            with open(os.path.join(path, spec["files"]["dictionary"])) as f:
+                self.dictionary = json.load(f)
+
+    @property
+    def nbytes(self):
+        return sum(array.nbytes for array in self.arrays.values())
+
+    def has(self, row):
+        return self.present is None or bool(self.present[row])
+
+    def value(self, row):
+        if self.type in ["int64", "float64"]:
+            return self.arrays["values"][row].item()
+        if self.type == "date":
+            return EPOCH + timedelta(microseconds=int(self.arrays["values"][row]))
+        if self.type == "objectid":
+            return bson.ObjectId(self.arrays["values"][row].tobytes())
+        if self.type == "list":
+            offsets = self.arrays["offsets"]
+            return [self.dictionary[code] for code in self.arrays["codes"][offsets[row]:offsets[row + 1]]]
+        return self.dictionary[self.arrays["codes"][row]]
+
+    def values(self, rows):
+        """[self.value(row) for row in rows], decoded with one array lookup per column."""
+        if self.type in ["int64", "float64"]:
+            return self.arrays["values"][rows].tolist()
+        if self.type == "date":
+            return [EPOCH + timedelta(microseconds=value) for value in self.arrays["values"][rows].tolist()]
+        if self.type == "objectid":
+            return [bson.ObjectId(value.tobytes()) for value in self.arrays["values"][rows]]
+        if self.type == "list":
+            offsets = self.arrays["offsets"]
+            codes = self.arrays["codes"]
+            return [[self.dictionary[code] for code in codes[start:end].tolist()]
+                    for start, end in zip(offsets[rows].tolist(), offsets[rows + 1].tolist())]
+        return [self.dictionary[code] for code in self.arrays["codes"][rows].tolist()]
+
+    def lengths(self):
+        """Number of items per row of a list column."""
+        if self._lengths is None:
+            self._lengths = np.diff(self.arrays["offsets"])
+        return self._lengths
+
+    def present_rows(self):
+        if self.present is None:
+            return slice(None)
+        return np.asarray(self.present)
+
+
+class Rows(object):
+    """The table as a read-only sequence of documents, decoded on access."""
+
+    def __init__(self, table, names):
+        self.table = table
+        self.columns = [(name, table.columns[name]) for name in names]
+
+    def __len__(self):
+        return len(self.table)
+
+    def __getitem__(self, row):
+        if isinstance(row, slice):
+            return [self[i] for i in range(*row.indices(len(self)))]
+        if row < 0:
+            row += len(self)
+        if row < 0 or row >= len(self):
+            raise IndexError(row)
+        return dict((name, column.value(row)) for name, column in self.columns if column.has(row))
+
+    def __iter__(self):
+        for row in range(0, len(self)):
+            yield self[row]
+
+    def select(self, rows, names):
+        """[self[row] for row in rows] with only the columns in `names`, decoded column by column."""
+        rows = np.asarray(rows, dtype=np.int64).reshape(-1)
+        documents = [{} for row in rows]
+        for name, column in self.columns:
+            if name not in names:
+                continue
+            values = column.values(rows)
+            if column.present is None:
+                for document, value in zip(documents, values):
+                    document[name] = value
+            else:
+                for document, value, present in zip(documents, values, column.present[rows].tolist()):
+                    if present:
+                        document[name] = value
+        return documents
+
+    def lengths(self, name):
+        """Items per row of the list column `name` (0 where it is missing)."""
+        return self.table.columns[name].lengths()
+
+    @property
+    def nbytes(self):
+        return sum(column.nbytes for name, column in self.columns)
+
+
+class Table(object):
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, MANIFEST)) as f:
+            self.manifest = json.load(f, object_pairs_hook=OrderedDict)
+        self.version = self.manifest["version"]
+        self.columns = OrderedDict((name, Column(path, spec)) for name, spec in self.manifest["columns"].items())
+
+    def __len__(self):
+        return self.manifest["rows"]
+
+    def rows(self, with_id=False):
+        return Rows(self, [name for name in self.columns.keys() if with_id or name != "_id"])
+
+    def meta(self, cols):
+        """Column metadata in the form metadata.discover_meta gives."""
+        meta = {}
+        if len(self) == 0:
+            return meta
+
+        for key in cols:
+            column = self.columns[key]
+            present = column.present_rows()
+            if key == "date" and column.type == "date":
+                values = column.arrays["values"][present]
+                meta[key] = {"type": "date", "min": EPOCH + timedelta(microseconds=int(values.min())),
+                             "max": EPOCH + timedelta(microseconds=int(values.max()))}
+            elif column.type in ["int64", "float64"]:
+                values = column.arrays["values"][present]
+                meta[key] = {"type": "number", "min": values.min().item(), "max": values.max().item()}
+            elif column.type == "category":
+                used = np.unique(column.arrays["codes"][present])
+                values = [column.dictionary[code] for code in used if column.dictionary[code] is not None]
+                # typed by the values present: row 0 may not have the column at all
+                if len(values) > 0 and isinstance(values[0], STRING_TYPES):
+                    meta[key] = {"type": "string", "values": sorted(values)}
+        return meta
+
+    def encode(self, focus, meta, weight="inverse"):
+        """encoding.encode(self.rows(), focus, meta, weight), computed on the columns."""
+        n = len(self)
+        dense = []
+        codes = []
+        weights = []
+        cardinalities = []
+        layout = []
+
+        for key in focus:
+            column = self.columns[key]
+            present = np.ones(n, dtype=bool) if column.present is None else np.asarray(column.present)
+
+            if meta[key]["type"] == "string":
+                lookup = dict((value, i) for i, value in enumerate(meta[key]["values"]))
+                remap = np.array([lookup.get(value, encoding.MISSING) for value in column.dictionary], dtype=np.int32)
+                codes.append(np.where(present, remap[column.arrays["codes"]], encoding.MISSING))
+                weights.append(encoding.category_weight(meta[key]["values"], weight))
+                cardinalities.append(len(meta[key]["values"]))
+                layout.append(("codes", len(codes) - 1))
+
+            elif meta[key]["type"] == "number":
+                low, high = meta[key]["min"], meta[key]["max"]
+                values = (column.arrays["values"] - low) * 1.0 / (high - low)
+                dense.append(np.where(present, values, 0.))
+                layout.append(("dense", len(dense) - 1))
+
+            elif meta[key]["type"] == "date":
+                low = microseconds(meta[key]["min"])
+                span = (meta[key]["max"] - meta[key]["min"]).total_seconds()
+                values = (column.arrays["values"] - low) / 1e6 / span
+                dense.append(np.where(present, values, 0.))
+                layout.append(("dense", len(dense) - 1))
+
+        return encoding.Encoded(
+            np.array(dense, dtype=float).T.reshape((n, len(dense))),
+            np.array(codes, dtype=np.int32).T.reshape((n, len(codes))),
+            np.array(weights, dtype=float),
+            np.array(cardinalities, dtype=np.int64),
+            layout)
+
+    def list_counts(self, name):
+        """{item: number of occurrences} of a list column, like an $unwind/$group."""
+        column = self.columns[name]
+        counts = np.bincount(column.arrays["codes"], minlength=len(column.dictionary))
+        return dict((column.dictionary[code], int(count)) for code, count in enumerate(counts) if count > 0)
+
+
+def current_version(directory):
+    """The version CURRENT under `directory` names, or None."""
+    if directory is None or not os.path.isfile(os.path.join(directory, CURRENT)):
+        return None
+    with open(os.path.join(directory, CURRENT)) as f:
+        return f.read().strip()
+
+
+def open_current(directory):
+    """The CURRENT version under `directory`, or None when there is none (or it is of another format)."""
+    version = current_version(directory)
+    if version is None:
+        return None
+
+    table = Table(os.path.join(directory, version))
+    if table.manifest.get("format") != FORMAT:
+        return None
+    return table
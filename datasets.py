@@ -0,0 +1,671 @@
+import os
+import sys
+import json
+import time
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from scipy.spatial import distance
+
+import columnar
+import encoding
+import incremental
+import inflight
+import instrumentation
+import metadata
+import minhash
+import reads
+import sampling
+import snapshots
+import neighbors
+import spatial
+import timeline
+import topk
+from instrumentation import stage, observe
+
+## Dataset definitions and the registry that loads them for server.py and the apps.
+##
+## A dataset is described in datasets.json by its collection, the columns used for the
+## feature vectors, the annotation column (if any) and its clustering setup. Datasets are
+## loaded on first use and the least recently used ones are dropped again when the loaded
+## total goes over the configured memory budget. All datasets share one MongoClient
+## (and with it one connection pool) and the metadata cache directory. The loaded state
+## of a dataset is one immutable snapshot (see snapshots.py): request pipelines take it
+## once and keep per-request values to themselves, so requests can run concurrently.
+## When re-ingest makes another columnar version CURRENT, the next request (looking at
+## most every RELOAD_CHECK_SECONDS) builds a snapshot of it and swaps it in; requests
+## keep using the old one until then.
+
+DEFAULT_CLUSTERS = 10
+RELOAD_CHECK_SECONDS = 5
+DEFAULT_CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), "datasets.json")
+
+
+## adjust the datetime variables from ISO strings to python compatible variable
+def fix(query):
+    if "$and" not in query.keys():
+        return query
+
+    for obj in query["$and"]:
+        if "date" in obj.keys():
+            for date_range in obj["date"]["$in"]:
+                date_range = timeline.parse_date(date_range)
+
+        if "$or" in obj.keys():
+            for obj2 in obj["$or"]:
+                if "date" in obj2.keys():
+                    obj2["date"]["$gte"] = timeline.parse_date(obj2["date"]["$gte"])
+                    obj2["date"]["$lte"] = timeline.parse_date(obj2["date"]["$lte"])
+
+    return query
+
+
+def merge_threshold(req):
+    """The Jaccard threshold /order merges annotations at, or None; ValueError for bad input."""
+    merge = req.get("merge")
+    if merge is None or merge is False:
+        return None
+    if merge is True:
+        return minhash.THRESHOLD
+    return minhash.parse_threshold(merge)
+
+
+def top_k(req):
+    """The number of outlying and central points /order keeps per annotation, or None; ValueError for bad input."""
+    if req.get("top_k") is None:
+        return None
+    return topk.parse_k(req["top_k"])
+
+
+def select(data, indices, names):
+    """The documents at `indices`; a columnar snapshot only decodes the `names` columns."""
+    if isinstance(data, columnar.Rows):
+        return data.select(indices, names)
+    return [data[index] for index in indices]
+
+
+def document_size(document):
+    size = sys.getsizeof(document)
+    for key, value in document.items():
+        size += sys.getsizeof(key) + sys.getsizeof(value)
+        if isinstance(value, list):
+            size += sum(sys.getsizeof(v) for v in value)
+    return size
+
+
+class Dataset(object):
+    """One annotated collection, its feature matrix and the derived structures."""
+
+    def __init__(self, name, config, client, cache_dir=None):
+        self.name = name
+        self.config = config
+        self.collection = client[config["database"]][config["collection"]]
+        self.cols = config["cols"]
+        self.annotation_col = config.get("annotation")
+        self.page = config.get("page")
+        # "inverse" scales one-hot categories by 1/len(values), "unit" uses 1
+        self.category_weight = config.get("category_weight", "inverse")
+        # "codes" keeps string columns as category codes (see encoding.py), "onehot" as vectors
+        self.encoding = config.get("encoding", "onehot")
+
+        clustering = config.get("clustering", {})
+        self.num_clusters = clustering.get("clusters", DEFAULT_CLUSTERS)
+        self.cluster_metric = clustering.get("metric", "cosine")
+        self.cluster_method = clustering.get("method", "average")
+        self.precompute_clusters = clustering.get("precompute", False)
+
+        # {"latitude": column, "longitude": column} for datasets shown on a map
+        self.spatial = config.get("spatial")
+        # {"date": column, "splits": [columns]} for datasets with a timeline
+        self.timeline = config.get("timeline")
+        # the spatial mask and the timeline refresh look documents up by _id
+        self.keep_ids = self.spatial is not None or self.timeline is not None
+
+        # columnar snapshot written at ingest (see columnar.py), used instead of Mongo when present
+        self.columns_dir = config.get("columns")
+
+        self.meta_cache = None
+        if cache_dir is not None:
+            self.meta_cache = os.path.join(cache_dir, name + "-meta.pkl")
+
+        self.lock = threading.Lock()
+        self.meta = {}
+        self.next_check = 0.
+        self.score_cache = incremental.ScoreCache()
+        self.member_store = topk.MemberStore()
+        self.inflight = inflight.InFlight()
+        self.unload()
+
+    @property
+    def loaded(self):
+        return self.snapshot is not None
+
+    def unload(self):
+        self.snapshot = None
+        self.score_cache.clear()
+        self.member_store.clear()
+
+    def build(self):
+        table = columnar.open_current(self.columns_dir)
+        data, features = self.create_feature_vectors({}, table)
+        distributions = {}
+        if self.annotation_col is not None and table is not None:
+            distributions = table.list_counts(self.annotation_col)
+        elif self.annotation_col is not None:
+            distributions = self.find_annotation_distributions({})
+        version = table.manifest["version"] if table is not None else None
+        snapshot = snapshots.Snapshot(data=data, features=features, distributions=distributions,
+                                      meta=self.meta, columns_version=version)
+
+        if self.precompute_clusters:
+            snapshot.derive("clusters", self.compute_clusters)
+        if self.spatial is not None:
+            snapshot.derive("spatial", self.build_spatial_index)
+        if self.timeline is not None:
+            snapshot.derive("timeline", self.build_time_pyramid)
+        return snapshot
+
+    def load(self):
+        """Builds the snapshot if needed and returns it."""
+        with self.lock:
+            if self.snapshot is None:
+                self.snapshot = self.build()
+            return self.snapshot
+
+    def reload(self, old):
+        """Builds a snapshot of the CURRENT columnar version and swaps it in for `old`."""
+        with self.lock:
+            if self.snapshot is not old and self.snapshot is not None:
+                return self.snapshot
+            # a new dict: `old` keeps the meta its features were encoded with
+            self.meta = {}
+            self.snapshot = self.build()
+            # members are kept by position in the old snapshot's rows
+            self.member_store.clear()
+            return self.snapshot
+
+    def changed(self, snapshot):
+        """True when CURRENT names another version than `snapshot` was built from."""
+        if self.columns_dir is None or time.time() < self.next_check:
+            return False
+        self.next_check = time.time() + RELOAD_CHECK_SECONDS
+        return columnar.current_version(self.columns_dir) != snapshot.columns_version
+
+    def current(self):
+        """The loaded snapshot; a dataset evicted in the meantime is loaded again."""
+        snapshot = self.snapshot
+        if snapshot is None:
+            snapshot = self.load()
+        elif self.changed(snapshot):
+            snapshot = self.reload(snapshot)
+        return snapshot
+
+    def nbytes(self):
+        snapshot = self.snapshot
+        if snapshot is None:
+            return 0
+
+        size = 0
+        if isinstance(snapshot.data, columnar.Rows):
+            size += snapshot.data.nbytes
+        elif len(snapshot.data) > 0:
+            sample = snapshot.data[:100]
+            size += sum(document_size(d) for d in sample) * len(snapshot.data) // len(sample)
+        if snapshot.features is not None:
+            size += snapshot.features.nbytes
+        clusters = snapshot.derived.get("clusters")
+        if clusters is not None:
+            size += sum(array.nbytes for array in clusters)
+        return size + snapshot.derived_nbytes()
+
+    def load_meta(self, table=None):
+        if len(self.meta.keys()) > 0:
+            return
+
+        if table is not None:
+            self.meta.update(table.meta(self.cols))
+            return
+
+        discovered, cached = metadata.load_meta(self.collection, self.cols, self.meta_cache)
+        if cached:
+            instrumentation.cache_hit("meta")
+        else:
+            instrumentation.cache_miss("meta")
+        self.meta.update(discovered)
+
+    ## feature encoding
+
+    def feature_vector(self, document, focus, meta):
+        feature = []
+        for key in focus:
+            if meta[key]["type"] == "number":
+                if key in document:
+                    feature.append((document[key] - meta[key]["min"]) * 1.0 / (meta[key]["max"] - meta[key]["min"]))
+                else:
+                    feature.append(0.)
+            elif meta[key]["type"] == "string":
+                weight = 1.
+                if self.category_weight == "inverse":
+                    weight = 1. / len(meta[key]["values"])
+                for category in meta[key]["values"]:
+                    if key in document and category == document[key]:
+                        feature.append(weight)
+                    else:
+                        feature.append(0.)
+            elif meta[key]["type"] == "date":
+                if key in document:
+                    feature.append(
+                        (document[key] - meta[key]["min"]).total_seconds() * 1.0 / (meta[key]["max"] - meta[key]["min"]).total_seconds())
+                else:
+                    feature.append(0.)
+        return feature
+
+    def encode(self, documents, focus, meta):
+        if self.encoding == "codes":
+            return encoding.encode(documents, focus, meta, self.category_weight)
+        return np.array([self.feature_vector(document, focus, meta) for document in documents])
+
+    def create_feature_vectors(self, query, table=None):
+        self.load_meta(table)
+
+        if table is not None:
+            if len(table) == 0:
+                return [], None
+            features = table.encode(self.cols, self.meta, self.category_weight)
+            return table.rows(with_id=self.keep_ids), features if self.encoding == "codes" else features.to_dense()
+
+        query = fix(query)
+        documents = reads.load(self.collection, query, with_id=self.keep_ids)
+        if len(documents) == 0:
+            return [], None
+
+        return documents, self.encode(documents, self.cols, self.meta)
+
+    def find_annotation_distributions(self, query):
+        pipeline = [
+            {"$match": fix(query)},
+            {"$unwind": "$" + self.annotation_col},
+            {"$group": {"_id": "$" + self.annotation_col, "value": {"$sum": 1}}},
+        ]
+
+        distributions = {}
+        for document in self.collection.aggregate(pipeline):
+            distributions[document["_id"]] = document["value"]
+        return distributions
+
+    ## structures derived from a snapshot, built once per snapshot
+
+    def compute_clusters(self, snapshot):
+        """(distance matrix, linkage) of the whole dataset."""
+        from scipy.cluster import hierarchy
+
+        condensed = encoding.pdist(snapshot.features, self.cluster_metric)
+        return distance.squareform(condensed), hierarchy.linkage(condensed, metric=self.cluster_metric, method=self.cluster_method)
+
+    def build_spatial_index(self, snapshot):
+        latitude, longitude = self.spatial["latitude"], self.spatial["longitude"]
+        documents = select(snapshot.data, range(0, len(snapshot.data)), [latitude, longitude, "_id"])
+        return spatial.SpatialIndex(documents, latitude, longitude)
+
+    def build_time_pyramid(self, snapshot):
+        date, splits = self.timeline["date"], self.timeline.get("splits", [])
+        documents = select(snapshot.data, range(0, len(snapshot.data)), [date, "_id"] + splits)
+        return timeline.TimePyramid(documents, date, splits)
+
+    def build_annotation_members(self, snapshot):
+        members = {}
+        documents = select(snapshot.data, range(0, len(snapshot.data)), [self.annotation_col])
+        for index, document in enumerate(documents):
+            for text in document[self.annotation_col]:
+                members.setdefault(text, []).append(index)
+        return members
+
+    ## request pipelines
+
+    def retrieve_data_from_query(self, query):
+        with stage("fix"):
+            query = fix(query)
+
+        # dates are left as datetimes and written as ISO strings by the serializer
+        with stage("mongo"):
+            return list(reads.find(self.collection, query))
+
+    def sample_data_from_query(self, query, max_rows, column=None):
+        with stage("fix"):
+            query = fix(query)
+
+        # by annotation presence unless another column is asked for
+        if column is None and self.annotation_col is not None:
+            stratum = sampling.stratum_of(self.annotation_col, True)
+        else:
+            stratum = sampling.stratum_of(column)
+        with stage("mongo"):
+            return sampling.stratified(reads.find(self.collection, query), max_rows, stratum)
+
+    def raw_data_from_query(self, query):
+        with stage("fix"):
+            query = fix(query)
+
+        with stage("mongo"):
+            return reads.raw(self.collection, query)
+
+    def annotated_indices(self, snapshot, indices):
+        if self.annotation_col is None:
+            return list(indices)
+        if isinstance(snapshot.data, columnar.Rows):
+            indices = np.asarray(indices, dtype=np.int64).reshape(-1)
+            return indices[snapshot.data.lengths(self.annotation_col)[indices] > 0].tolist()
+        return [index for index in indices if len(snapshot.data[index][self.annotation_col]) > 0]
+
+    def extract_feature_vectors(self, snapshot, indices, focus):
+        newIndices = self.annotated_indices(snapshot, indices)
+        return newIndices, self.encode(select(snapshot.data, newIndices, focus), focus, snapshot.meta)
+
+    def extract_variation(self, documents, focus, meta):
+        minmax = {}
+        for key in focus:
+            for document in documents:
+                if key not in document:
+                    continue
+                if meta[key]["type"] == "string":
+                    minmax.setdefault(key, set()).add(document[key])
+                else:
+                    if key not in minmax:
+                        minmax[key] = [document[key], document[key]]
+                    minmax[key][0] = min(minmax[key][0], document[key])
+                    minmax[key][1] = max(minmax[key][1], document[key])
+
+        variance = {}
+        for key in focus:
+            v = {"key": key}
+            if meta[key]["type"] == "number":
+                v["variance"] = (minmax[key][1] - minmax[key][0]) * 1.0 / (meta[key]["max"] - meta[key]["min"])
+                v["range"] = minmax[key]
+                v["values"] = minmax[key]
+
+            elif meta[key]["type"] == "string":
+                v["variance"] = (len(minmax[key]) - 1) * 1.0 / len(meta[key]["values"])
+                v["range"] = len(minmax[key])
+                v["values"] = list(minmax[key])
+
+            elif meta[key]["type"] == "date":
+                v["variance"] = (minmax[key][1] - minmax[key][0]).total_seconds() * 1.0 / (meta[key]["max"] - meta[key]["min"]).total_seconds()
+                v["range"] = [minmax[key][0].strftime("%c"), minmax[key][1].strftime("%c")]
+                v["values"] = v["range"]
+
+            variance[key] = v
+
+        return variance
+
+    def extract_unique(self, distance_matrix, indices):
+        average_distances = []
+        total_sum = 0.
+        total_num = 0.
+
+        for index1 in range(0, len(indices)):
+            for index2 in range(0, len(indices)):
+                total_sum += distance_matrix[indices[index1], indices[index2]]
+                total_num += 1.
+            average_distances.append({
+                "index": index1,
+                "rank": total_sum / total_num
+            })
+
+        average_distances.sort(key=lambda x: -1 * x["rank"])
+        return average_distances
+
+    def distances(self, req):
+        snapshot = self.current()
+        focus = self.cols if req["focus"] is None else req["focus"]
+        with stage("features"):
+            indices, features = self.extract_feature_vectors(snapshot, req["indices"], focus)
+
+        observe("selection_size", len(req["indices"]))
+        observe("annotated_size", len(features))
+
+        with stage("pdist"):
+            return encoding.tiled_squareform(features, req["measure"], inflight.check)
+
+    def group_order(self, req):
+        snapshot = self.current()
+        focus = self.cols if req["focus"] is None else req["focus"]
+        columns = req["cols"]
+        measure = req["measure"]
+        indices = self.annotated_indices(snapshot, req["indices"])
+
+        observe("selection_size", len(req["indices"]))
+        observe("annotated_size", len(indices))
+
+        if len(indices) == 0:
+            return []
+
+        # consecutive brushes of one session only pay for the points that changed
+        session = req.get("session")
+        key = (snapshot.version, session, tuple(focus), measure) if session is not None else None
+        scores = self.score_cache.scores(key, indices, lambda subset: self.extract_feature_vectors(snapshot, subset, focus)[1], measure)
+
+        # scores belong to this request only, the snapshot's documents are never written
+        with stage("scores"):
+            score = dict((indices[i], float(scores[i])) for i in range(0, len(indices)))
+
+        # the columns read below, decoded once for the whole selection
+        with stage("select"):
+            rows = dict(zip(indices, select(snapshot.data, indices, list(set(columns) | set(focus) | set([self.annotation_col])))))
+
+        with stage("grouping"):
+            data_groups = {}
+            for index in indices:
+                datum = rows[index]
+                if len(columns) == 1:
+                    keys = datum[columns[0]]
+                else:
+                    keys = dict((col, datum[col]) for col in columns)
+
+                stringKey = json.dumps(keys)
+                if stringKey not in data_groups:
+                    data_groups[stringKey] = {"id": stringKey, "indices": [], "annotations": [], "key": keys, "count": 0}
+                data_groups[stringKey]["indices"].append(index)
+                data_groups[stringKey]["count"] += 1
+
+        # near-duplicate annotations are grouped under their most frequent text
+        representative = None
+        totals = snapshot.distributions
+        threshold = merge_threshold(req)
+        if threshold is not None:
+            with stage("merge"):
+                representative = self.annotation_index(snapshot).representative_map(threshold)
+                totals = self.annotation_index(snapshot).merged_counts(threshold)
+
+        # reorder to get annotation data
+        for key in sorted(data_groups.keys()):
+            inflight.check()
+            data_group = data_groups[key]
+            annotation_group = OrderedDict()
+            merged = {}
+            for index in data_group["indices"]:
+                datum = rows[index]
+                annotations = datum[self.annotation_col]
+                if representative is not None:
+                    for text in annotations:
+                        merged.setdefault(representative.get(text, text), set()).add(text)
+                    annotations = minhash.merge(annotations, representative)
+
+                for annotation in annotations:
+                    if annotation not in annotation_group:
+                        annotation_group[annotation] = {
+                            "annotation": annotation,
+                            "scores": [],
+                            "indices": [],
+                            "range": [10000000, -10000000]
+                        }
+                    group = annotation_group[annotation]
+                    group["scores"].append(score[index])
+                    group["indices"].append(index)
+                    group["range"][0] = min(group["range"][0], score[index])
+                    group["range"][1] = max(group["range"][1], score[index])
+
+            for annotation, group in annotation_group.items():
+                inflight.check()
+                with stage("variation"):
+                    group["variance"] = self.extract_variation([rows[index] for index in group["indices"]], focus, snapshot.meta)
+                group["current_points"] = len(group["indices"])
+                group["total_points"] = totals[annotation]
+                if representative is not None:
+                    group["merged"] = sorted(merged[annotation])
+
+            data_group["annotations"] = list(annotation_group.values())
+
+        returnData = [data_groups[key] for key in sorted(data_groups.keys())]
+
+        # bounded response: k outliers and k central points per annotation, members on demand
+        k = top_k(req)
+        if k is not None:
+            with stage("top_k"):
+                returnData, members = topk.compact_groups(returnData, k)
+            if session is not None:
+                self.member_store.put(session, req.get("view"), members)
+
+        return returnData
+
+    def neighbors(self, req):
+        snapshot = self.current()
+        index = snapshot.derive("neighbors", lambda s: neighbors.NeighborIndex(s.features))
+
+        with stage("neighbors"):
+            return neighbors.answer(index, req, lambda annotation: self.members_of(snapshot, annotation))
+
+    def viewport(self, req):
+        if self.spatial is None:
+            return None
+        spatial_index = self.current().derive("spatial", self.build_spatial_index)
+
+        mask = None
+        query = req.get("query") or {}
+        if len(query.keys()) > 0:
+            with stage("fix"):
+                query = fix(query)
+            with stage("mongo"):
+                mask = spatial_index.mask(d["_id"] for d in self.collection.find(query, {"_id": True}))
+
+        with stage("viewport"):
+            return spatial_index.viewport(req["bounds"], req["zoom"], mask)
+
+    def time_counts(self, req):
+        if self.timeline is None:
+            return None
+        # the pyramid keeps counting inserts after the snapshot was taken, under its own lock
+        time_pyramid = self.current().derive("timeline", self.build_time_pyramid)
+
+        with stage("ingest"):
+            observe("timeline_added", time_pyramid.refresh(self.collection))
+
+        with stage("timeline"):
+            return time_pyramid.query(req.get("granularity"), req.get("start"), req.get("end"),
+                                      req.get("split"), req.get("values"))
+
+    def annotation_index(self, snapshot):
+        return snapshot.derive("annotation_index", lambda s: minhash.AnnotationIndex(s.distributions))
+
+    def similar_annotations(self, req):
+        if self.annotation_col is None:
+            return None
+
+        with stage("similar"):
+            matches = self.annotation_index(self.current()).similar(
+                req["annotation"], minhash.parse_threshold(req.get("threshold", minhash.THRESHOLD)), req.get("k"))
+        return {"annotation": req["annotation"], "matches": matches}
+
+    def members_of(self, snapshot, annotation):
+        if self.annotation_col is None:
+            return []
+        return snapshot.derive("annotation_members", self.build_annotation_members).get(annotation, [])
+
+    def cluster_meta(self, req):
+        from scipy.cluster import hierarchy
+
+        snapshot = self.current()
+        with stage("linkage"):
+            distance_matrix, clusters = snapshot.derive("clusters", self.compute_clusters)
+
+        with stage("cut_tree"):
+            clusterLabels = hierarchy.cut_tree(clusters, n_clusters=[self.num_clusters])
+
+        restructuredData = [[] for i in range(0, self.num_clusters)]
+        for i, label in enumerate(clusterLabels):
+            restructuredData[label[0]].append(i)
+
+        with stage("extract_unique"):
+            clusterMeta = [self.extract_unique(distance_matrix, members) for members in restructuredData]
+
+        return {"annotations": clusterMeta}
+
+
+class DatasetRegistry(object):
+    """Loads datasets on demand and evicts the least recently used over the budget."""
+
+    def __init__(self, configs, client, memory_budget, cache_dir=None):
+        self.datasets = OrderedDict()
+        for name in sorted(configs.keys()):
+            self.datasets[name] = Dataset(name, configs[name], client, cache_dir)
+        self.memory_budget = memory_budget
+        self.recent = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __contains__(self, name):
+        return name in self.datasets
+
+    def names(self):
+        return list(self.datasets.keys())
+
+    def get(self, name):
+        dataset = self.datasets[name]
+        if dataset.loaded:
+            instrumentation.cache_hit("datasets")
+        else:
+            instrumentation.cache_miss("datasets")
+            dataset.load()
+
+        with self.lock:
+            self.recent.pop(name, None)
+            self.recent[name] = dataset
+            self.evict(keep=name)
+
+        return dataset
+
+    def evict(self, keep):
+        total = sum(d.nbytes() for d in self.recent.values())
+        for name in list(self.recent.keys()):
+            if total <= self.memory_budget:
+                break
+            if name == keep:
+                continue
+            dataset = self.recent.pop(name)
+            total -= dataset.nbytes()
+            print("Evicting dataset " + name)
+            # requests still holding the old snapshot finish with it
+            with dataset.lock:
+                dataset.unload()
+
+    def status(self):
+        with self.lock:
+            return [{
+                "name": name,
+                "loaded": snapshot is not None,
+                "rows": len(snapshot.data) if snapshot is not None else 0,
+                "bytes": dataset.nbytes()
+            } for name, dataset, snapshot in [(name, d, d.snapshot) for name, d in self.datasets.items()]]
+
+
+def load_config(path=DEFAULT_CONFIG):
+    """The JSON config at `path`; its relative directories are taken relative to that file."""
+    with open(path) as f:
+        config = json.load(f)
+
+    root = os.path.dirname(os.path.abspath(path))
+    if config.get("cache_dir") is not None:
+        config["cache_dir"] = os.path.join(root, config["cache_dir"])
+    for dataset in config.get("datasets", {}).values():
+        if dataset.get("columns") is not None:
+            dataset["columns"] = os.path.join(root, dataset["columns"])
+    return config
@@ -0,0 +1,338 @@
+import numpy as np
+from scipy.spatial import distance
+
+## Categorical columns as integer codes instead of one-hot vectors.
+##
+## A one-hot encoded string column with weight w contributes to the distance between two
+## rows only through whether their categories match: 0 if equal, two coordinates of w if
+## both present and different, one if only one row has the column. Encoded keeps the
+## scaled numeric/date columns in a dense matrix and each string column as one int32
+## code (-1 when missing), and pdist/cdist below add the categorical terms straight from
+## the codes. Results match scipy on the one-hot matrix for euclidean, sqeuclidean,
+## cityblock, chebyshev, cosine and correlation; other metrics densify first. Memory and
+## distance time no longer grow with the number of categories.
+
+CODE_METRICS = ["euclidean", "sqeuclidean", "cityblock", "chebyshev", "cosine", "correlation"]
+MISSING = -1
+# distances per tile of triangle_tiles() (8 bytes each)
+TILE_ELEMENTS = 1 << 22
+
+
+def category_weight(values, weight):
+    if weight == "inverse":
+        return 1. / len(values)
+    return 1.
+
+
+class Encoded(object):
+    """Feature rows as dense numeric/date columns plus category codes."""
+
+    def __init__(self, dense, codes, weights, cardinalities, layout):
+        self.dense = dense
+        self.codes = codes
+        self.weights = weights
+        self.cardinalities = cardinalities
+        # ("dense", column) / ("codes", column) in focus order, for to_dense()
+        self.layout = layout
+
+    def __len__(self):
+        return self.dense.shape[0]
+
+    def __getitem__(self, rows):
+        return Encoded(self.dense[rows], self.codes[rows], self.weights, self.cardinalities, self.layout)
+
+    @property
+    def nbytes(self):
+        return self.dense.nbytes + self.codes.nbytes
+
+    @property
+    def dimensions(self):
+        """Width of the equivalent one-hot matrix."""
+        return self.dense.shape[1] + int(self.cardinalities.sum())
+
+    def to_dense(self):
+        """The one-hot matrix the codes stand for."""
+        columns = []
+        for kind, j in self.layout:
+            if kind == "dense":
+                columns.append(self.dense[:, j:j + 1])
+            else:
+                onehot = np.zeros((len(self), self.cardinalities[j]))
+                present = np.flatnonzero(self.codes[:, j] >= 0)
+                onehot[present, self.codes[present, j]] = self.weights[j]
+                columns.append(onehot)
+        if len(columns) == 0:
+            return np.zeros((len(self), 0))
+        return np.hstack(columns)
+
+    def squared_norms(self):
+        present = (self.codes >= 0).astype(float)
+        return (self.dense * self.dense).sum(axis=1) + present.dot(self.weights * self.weights)
+
+    def sums(self):
+        present = (self.codes >= 0).astype(float)
+        return self.dense.sum(axis=1) + present.dot(self.weights)
+
+    def split(self, vector):
+        """A vector of the one-hot space as (dense values, [category values per code column])."""
+        dense = np.zeros(self.dense.shape[1])
+        categories = [None] * self.codes.shape[1]
+        position = 0
+        for kind, j in self.layout:
+            if kind == "dense":
+                dense[j] = vector[position]
+                position += 1
+            else:
+                categories[j] = np.asarray(vector[position:position + self.cardinalities[j]], dtype=float)
+                position += self.cardinalities[j]
+        return dense, categories
+
+    def mean(self, rows):
+        """The mean of `rows` in the one-hot space, without expanding them."""
+        rows = np.asarray(rows, dtype=np.int64)
+        columns = []
+        for kind, j in self.layout:
+            if kind == "dense":
+                columns.append(self.dense[rows, j:j + 1].mean(axis=0))
+            else:
+                codes = self.codes[rows, j]
+                counts = np.bincount(codes[codes >= 0], minlength=self.cardinalities[j])
+                columns.append(self.weights[j] * counts / float(len(rows)))
+        if len(columns) == 0:
+            return np.zeros(0)
+        return np.concatenate(columns)
+
+
+def encode(documents, focus, meta, weight="inverse"):
+    """Encoded rows of `documents` over the `focus` columns, scaled as in the one-hot path."""
+    dense = []
+    codes = []
+    weights = []
+    cardinalities = []
+    layout = []
+
+    for key in focus:
+        if meta[key]["type"] == "string":
+            lookup = dict((value, i) for i, value in enumerate(meta[key]["values"]))
+            codes.append([lookup.get(document[key], MISSING) if key in document else MISSING for document in documents])
+            weights.append(category_weight(meta[key]["values"], weight))
+            cardinalities.append(len(meta[key]["values"]))
+            layout.append(("codes", len(codes) - 1))
+
+        elif meta[key]["type"] == "number":
+            low, high = meta[key]["min"], meta[key]["max"]
+            dense.append([(document[key] - low) * 1.0 / (high - low) if key in document else 0. for document in documents])
+            layout.append(("dense", len(dense) - 1))
+
+        elif meta[key]["type"] == "date":
+            low = meta[key]["min"]
+            span = (meta[key]["max"] - low).total_seconds()
+            dense.append([(document[key] - low).total_seconds() * 1.0 / span if key in document else 0. for document in documents])
+            layout.append(("dense", len(dense) - 1))
+
+    n = len(documents)
+    return Encoded(
+        np.array(dense, dtype=float).T.reshape((n, len(dense))),
+        np.array(codes, dtype=np.int32).T.reshape((n, len(codes))),
+        np.array(weights, dtype=float),
+        np.array(cardinalities, dtype=np.int64),
+        layout)
+
+
+def as_dense(features):
+    if isinstance(features, Encoded):
+        return features.to_dense()
+    return features
+
+
+def vstack(a, b):
+    if isinstance(a, Encoded):
+        return Encoded(np.vstack([a.dense, b.dense]), np.vstack([a.codes, b.codes]), a.weights, a.cardinalities, a.layout)
+    return np.vstack([a, b])
+
+
+def mismatches(a, b, pairwise):
+    """Per categorical column: 2 if both present and different, 1 if one is missing."""
+    result = []
+    for j in range(0, a.codes.shape[1]):
+        if b is None:
+            different = pairwise(a.codes[:, j:j + 1], "hamming")
+            one_missing = pairwise((a.codes[:, j:j + 1] < 0).astype(float), "hamming")
+        else:
+            different = pairwise(a.codes[:, j:j + 1], b.codes[:, j:j + 1], "hamming")
+            one_missing = pairwise((a.codes[:, j:j + 1] < 0).astype(float), (b.codes[:, j:j + 1] < 0).astype(float), "hamming")
+        result.append(2. * different - one_missing)
+    return result
+
+
+def combine(a, b, metric, pairwise, outer):
+    """Distances between code-encoded rows; `pairwise` is pdist or cdist, `outer` pairs per-row values."""
+    def numeric(name):
+        if b is None:
+            if a.dense.shape[1] == 0:
+                return np.zeros(len(a) * (len(a) - 1) // 2)
+            return pairwise(a.dense, name)
+        if a.dense.shape[1] == 0:
+            return np.zeros((len(a), len(b)))
+        return pairwise(a.dense, b.dense, name)
+
+    counts = mismatches(a, b, pairwise)
+
+    if metric == "cityblock":
+        result = numeric("cityblock")
+        for w, count in zip(a.weights, counts):
+            result += w * count
+        return result
+
+    if metric == "chebyshev":
+        result = numeric("chebyshev")
+        for w, count in zip(a.weights, counts):
+            result = np.maximum(result, w * (count > 0))
+        return result
+
+    squared = numeric("sqeuclidean")
+    for w, count in zip(a.weights, counts):
+        squared += w * w * count
+
+    if metric == "sqeuclidean":
+        return squared
+    if metric == "euclidean":
+        return np.sqrt(squared)
+
+    other = a if b is None else b
+    norms_a, norms_b = outer(a.squared_norms(), other.squared_norms())
+    if metric == "correlation":
+        dimensions = float(a.dimensions)
+        means_a, means_b = outer(a.sums() / dimensions, other.sums() / dimensions)
+        squared = squared - dimensions * (means_a - means_b) ** 2
+        norms_a = norms_a - dimensions * means_a ** 2
+        norms_b = norms_b - dimensions * means_b ** 2
+
+    # 1 - <u, v> / (|u| |v|), with <u, v> = (|u|^2 + |v|^2 - |u - v|^2) / 2
+    return 1. - (norms_a + norms_b - squared) / (2. * np.sqrt(norms_a * norms_b))
+
+
+def condensed_outer(values_a, values_b):
+    i, j = np.triu_indices(len(values_a), 1)
+    return values_a[i], values_b[j]
+
+
+def full_outer(values_a, values_b):
+    return values_a[:, np.newaxis], values_b[np.newaxis, :]
+
+
+def pdist(features, metric):
+    """scipy.spatial.distance.pdist that also takes Encoded rows."""
+    if not isinstance(features, Encoded):
+        return distance.pdist(features, metric)
+    if metric not in CODE_METRICS:
+        return distance.pdist(features.to_dense(), metric)
+    return combine(features, None, metric, distance.pdist, condensed_outer)
+
+
+def cdist(a, b, metric):
+    """scipy.spatial.distance.cdist that also takes Encoded rows."""
+    if not isinstance(a, Encoded):
+        return distance.cdist(a, b, metric)
+    if metric not in CODE_METRICS:
+        return distance.cdist(a.to_dense(), b.to_dense(), metric)
+    return combine(a, b, metric, distance.cdist, full_outer)
+
+
+def distances_to(features, vector, metric):
+    """cdist([vector], features, metric)[0] for a vector of the one-hot space.
+
+    Encoded rows are not expanded: each categorical column only needs the vector's value
+    at the row's category, so the result is exact for the CODE_METRICS.
+    """
+    vector = np.asarray(vector, dtype=float)
+    if not isinstance(features, Encoded):
+        return distance.cdist(vector[np.newaxis, :], features, metric)[0]
+    if metric not in CODE_METRICS:
+        return distance.cdist(vector[np.newaxis, :], features.to_dense(), metric)[0]
+
+    dense, categories = features.split(vector)
+    present = features.codes >= 0
+    # the vector's value at each row's category (0 for missing), and the row's value there
+    at_code = np.zeros(features.codes.shape)
+    for j, values in enumerate(categories):
+        if len(values) > 0:
+            at_code[:, j] = np.where(present[:, j], values[np.maximum(features.codes[:, j], 0)], 0.)
+    row_values = present * features.weights
+
+    if metric == "cityblock":
+        result = np.abs(features.dense - dense).sum(axis=1)
+        for j, values in enumerate(categories):
+            result += np.abs(values).sum() + present[:, j] * (np.abs(row_values[:, j] - at_code[:, j]) - np.abs(at_code[:, j]))
+        return result
+
+    if metric == "chebyshev":
+        result = np.abs(features.dense - dense).max(axis=1) if len(dense) > 0 else np.zeros(len(features))
+        for j, values in enumerate(categories):
+            if len(values) == 0:
+                continue
+            # the largest |value| away from the row's own category
+            magnitudes = np.abs(values)
+            order = np.argsort(-magnitudes)
+            second = magnitudes[order[1]] if len(values) > 1 else 0.
+            elsewhere = np.where(present[:, j] & (features.codes[:, j] == order[0]), second, magnitudes[order[0]])
+            own = np.where(present[:, j], np.abs(row_values[:, j] - at_code[:, j]), 0.)
+            result = np.maximum(result, np.maximum(own, elsewhere))
+        return result
+
+    dot = features.dense.dot(dense) + (row_values * at_code).sum(axis=1)
+    norms = features.squared_norms()
+    vector_norm = vector.dot(vector)
+    squared = np.maximum(norms - 2. * dot + vector_norm, 0.)
+
+    if metric == "sqeuclidean":
+        return squared
+    if metric == "euclidean":
+        return np.sqrt(squared)
+
+    if metric == "correlation":
+        dimensions = float(features.dimensions)
+        means = features.sums() / dimensions
+        vector_mean = vector.sum() / dimensions
+        dot = dot - dimensions * means * vector_mean
+        norms = norms - dimensions * means ** 2
+        vector_norm = vector_norm - dimensions * vector_mean ** 2
+    return 1. - dot / np.sqrt(norms * vector_norm)
+
+
+def triangle_tiles(features, metric, tile_elements=None):
+    """Yields (start, block): distances from a few rows to themselves and every later row.
+
+    Together the blocks cover each pair once, like pdist (entries on and below the
+    diagonal of a block are 0), and callers can stop between them.
+    """
+    n = len(features)
+    step = max(1, (tile_elements or TILE_ELEMENTS) // max(1, n))
+    for start in range(0, n, step):
+        block = cdist(features[start:start + step], features[start:], metric)
+        size = len(block)
+        block[:, :size] = np.triu(block[:, :size], 1)
+        yield start, block
+
+
+def tiled_sums(features, metric, between=None):
+    """Row sums of the square distance matrix, calling between() after every tile."""
+    sums = np.zeros(len(features))
+    for start, block in triangle_tiles(features, metric):
+        sums[start:start + len(block)] += block.sum(axis=1)
+        sums[start:] += block.sum(axis=0)
+        if between is not None:
+            between()
+    return sums
+
+
+def tiled_squareform(features, metric, between=None):
+    """The square distance matrix, calling between() after every tile."""
+    square = np.zeros((len(features), len(features)))
+    for start, block in triangle_tiles(features, metric):
+        stop = start + len(block)
+        square[start:stop, start:] += block
+        square[start:, start:stop] += block.T
+        if between is not None:
+            between()
+    return square
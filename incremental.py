@@ -0,0 +1,134 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+import encoding
+import inflight
+import instrumentation
+from instrumentation import stage, observe
+
+## Incremental /order scores for brushing sessions.
+##
+## The /order score of a point is its mean distance to every point of the selection.
+## For each (session, focus, measure) the last selection is kept together with its
+## feature rows and per-point distance sums. When the next selection differs by a few
+## points, only the distances between the added/removed points and the selection are
+## computed, O(delta * n) instead of O(n^2). Large deltas, unknown sessions and every
+## REFRESH_UPDATES-th update fall back to a full recompute.
+
+MAX_SESSIONS = 64
+FULL_RECOMPUTE_FRACTION = 0.25
+REFRESH_UPDATES = 50
+
+
+class SelectionState(object):
+
+    def __init__(self, indices, features, sums):
+        self.indices = list(indices)
+        self.features = features
+        self.sums = sums
+        self.position = dict((index, i) for i, index in enumerate(self.indices))
+        self.updates = 0
+
+
+def full_sums(features, measure):
+    if len(features) == 1:
+        return np.zeros(1)
+    # in tiles, so that a superseded /order stops early
+    with stage("pdist"):
+        return encoding.tiled_sums(features, measure, inflight.check)
+
+
+def as_matrix(features):
+    if isinstance(features, encoding.Encoded):
+        return features
+    features = np.asarray(features, dtype=float)
+    if features.ndim == 1:
+        features = features.reshape((0, 0))
+    return features
+
+
+class ScoreCache(object):
+    """Per-session selection state used to update /order scores incrementally."""
+
+    def __init__(self, max_sessions=MAX_SESSIONS, full_fraction=FULL_RECOMPUTE_FRACTION, refresh=REFRESH_UPDATES):
+        self.max_sessions = max_sessions
+        self.full_fraction = full_fraction
+        self.refresh = refresh
+        self.states = OrderedDict()
+        self.lock = threading.Lock()
+
+    def clear(self):
+        with self.lock:
+            self.states.clear()
+
+    def scores(self, key, indices, extract, measure):
+        """Mean distance of each of `indices` to all of them, aligned with `indices`.
+
+        `extract(indices)` returns the feature rows of the given indices.
+        """
+        if len(indices) == 0:
+            return np.zeros(0)
+
+        with self.lock:
+            previous = self.states.pop(key, None) if key is not None else None
+
+        state = None
+        if previous is not None:
+            state = self.update(previous, indices, extract, measure)
+
+        if state is None:
+            instrumentation.cache_miss("order_session")
+            with stage("features"):
+                features = as_matrix(extract(indices))
+            state = SelectionState(indices, features, full_sums(features, measure))
+        else:
+            instrumentation.cache_hit("order_session")
+
+        if key is not None:
+            with self.lock:
+                self.states[key] = state
+                while len(self.states) > self.max_sessions:
+                    self.states.popitem(last=False)
+
+        sums = np.array([state.sums[state.position[index]] for index in indices])
+        return sums / float(len(indices))
+
+    def update(self, state, indices, extract, measure):
+        current = set(indices)
+        if len(current) != len(indices):
+            return None
+
+        added = [index for index in indices if index not in state.position]
+        removed = [index for index in state.indices if index not in current]
+        delta = len(added) + len(removed)
+        observe("order_delta", delta)
+
+        if state.updates >= self.refresh or delta > self.full_fraction * len(indices):
+            return None
+        if delta == 0:
+            return state
+
+        with stage("delta"):
+            # delta is at most a fraction of the selection, so some points are always kept
+            keep = np.array([index in current for index in state.indices], dtype=bool)
+            kept_indices = [index for index in state.indices if index in current]
+            kept_features = state.features[keep]
+            sums = state.sums[keep]
+
+            if len(removed) > 0:
+                removed_features = state.features[[state.position[index] for index in removed]]
+                sums = sums - encoding.cdist(kept_features, removed_features, measure).sum(axis=1)
+
+            features = kept_features
+            if len(added) > 0:
+                with stage("features"):
+                    added_features = as_matrix(extract(added))
+                features = encoding.vstack(kept_features, added_features)
+                sums = sums + encoding.cdist(kept_features, added_features, measure).sum(axis=1)
+                sums = np.concatenate([sums, encoding.cdist(added_features, features, measure).sum(axis=1)])
+
+        next_state = SelectionState(kept_indices + added, features, sums)
+        next_state.updates = state.updates + 1
+        return next_state
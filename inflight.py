@@ -0,0 +1,105 @@
+import json
+import hashlib
+import threading
+
+from flask import g, has_request_context
+
+import instrumentation
+from instrumentation import stage
+
+## Coalescing and cancellation of in-flight /order and /distance computations.
+##
+## Dragging a brush sends a burst of requests of which only the last one is rendered.
+## Requests with the same route, snapshot version and body share one computation: the
+## first one runs it and the others wait for its result. Requests carrying a session
+## belong to a view (route, session, optional "view" field); a newer request of the same
+## view cancels the one before it. Cancellation is cooperative: the computation calls
+## check() between tiles and groups, which raises Superseded once it has been replaced.
+## The superseded request and any requests waiting on it then answer SUPERSEDED_STATUS,
+## and the newest request gets the server's full attention.
+
+SUPERSEDED_STATUS = 409
+
+
+class Superseded(Exception):
+    """Raised in a computation that a newer request of the same view replaced."""
+
+
+class Flight(object):
+
+    def __init__(self, view):
+        self.view = view
+        self.cancelled = threading.Event()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+def request_key(route, version, req):
+    body = json.dumps(req, sort_keys=True)
+    return route, version, hashlib.sha1(body.encode("utf-8")).hexdigest()
+
+
+def view_key(route, req):
+    """Requests of one view replace each other; there is no view without a session."""
+    if not isinstance(req, dict) or req.get("session") is None:
+        return None
+    return route, req["session"], json.dumps(req.get("view"), sort_keys=True)
+
+
+def check():
+    """Raises Superseded when the computation of the current request was replaced."""
+    if not has_request_context():
+        return
+    flight = getattr(g, "flight", None)
+    if flight is not None and flight.cancelled.is_set():
+        raise Superseded()
+
+
+class InFlight(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}
+        self.latest = {}
+
+    def run(self, key, view, compute):
+        """compute(), shared with identical requests in flight; raises Superseded when replaced."""
+        with self.lock:
+            flight = self.flights.get(key)
+            coalesced = flight is not None and not flight.cancelled.is_set()
+            if not coalesced:
+                flight = Flight(view)
+                self.flights[key] = flight
+                if view is not None:
+                    previous = self.latest.get(view)
+                    if previous is not None:
+                        previous.cancelled.set()
+                    self.latest[view] = flight
+
+        if coalesced:
+            instrumentation.cache_hit("inflight")
+            with stage("coalesced"):
+                flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        instrumentation.cache_miss("inflight")
+        if has_request_context():
+            g.flight = flight
+        try:
+            flight.result = compute()
+            return flight.result
+        except Exception, e:
+            flight.error = e
+            raise
+        finally:
+            if has_request_context():
+                g.flight = None
+            with self.lock:
+                if self.flights.get(key) is flight:
+                    del self.flights[key]
+                if view is not None and self.latest.get(view) is flight:
+                    del self.latest[view]
+            flight.done.set()
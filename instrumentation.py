@@ -0,0 +1,181 @@
+import json
+import threading
+from collections import deque
+from contextlib import contextmanager
+from timeit import default_timer as timer
+
+from flask import g, request, has_request_context
+
+## Per-request stage timing for the Flask apps.
+##
+## Wrap pipeline stages in `with stage("pdist"):` and call `observe(...)` for sizes.
+## Every response gets a Server-Timing header with the stages it went through, the
+## timings are kept in rolling histograms per route, and `/metrics` exposes them
+## together with payload sizes, selection sizes and cache hit rates.
+
+HISTOGRAM_WINDOW = 1024
+LATENCY_BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000]
+
+_lock = threading.Lock()
+_routes = {}
+_caches = {}
+
+
+class RollingHistogram(object):
+    """Keeps the last `window` samples and summarizes them on demand."""
+
+    def __init__(self, window=HISTOGRAM_WINDOW, buckets=None):
+        self.samples = deque(maxlen=window)
+        self.buckets = buckets
+        self.count = 0
+
+    def add(self, value):
+        self.samples.append(value)
+        self.count += 1
+
+    def summary(self):
+        values = sorted(self.samples)
+        summary = {"count": self.count, "window": len(values)}
+        if len(values) == 0:
+            return summary
+
+        summary["min"] = values[0]
+        summary["max"] = values[-1]
+        summary["mean"] = sum(values) / float(len(values))
+        for q in [50, 95, 99]:
+            summary["p" + str(q)] = values[min(len(values) - 1, int(len(values) * q / 100.))]
+
+        if self.buckets is not None:
+            counts = [0] * (len(self.buckets) + 1)
+            position = 0
+            for value in values:
+                while position < len(self.buckets) and value > self.buckets[position]:
+                    position += 1
+                counts[position] += 1
+            summary["buckets"] = [{"le": le, "count": c} for le, c in zip(self.buckets + ["inf"], counts)]
+
+        return summary
+
+
+def _route_metrics(rule):
+    if rule not in _routes:
+        _routes[rule] = {
+            "latency": RollingHistogram(buckets=LATENCY_BUCKETS_MS),
+            "stages": {},
+            "values": {}
+        }
+    return _routes[rule]
+
+
+## stage timing and value observation inside a request
+
+@contextmanager
+def stage(name):
+    if not has_request_context() or not hasattr(g, "timings"):
+        yield
+        return
+
+    start = timer()
+    try:
+        yield
+    finally:
+        elapsed = (timer() - start) * 1000.
+        # stages entered more than once per request (e.g. per group) are summed
+        if name not in g.timings:
+            g.timing_order.append(name)
+            g.timings[name] = 0.
+        g.timings[name] += elapsed
+
+
+def observe(name, value):
+    if has_request_context() and hasattr(g, "observations"):
+        g.observations[name] = value
+
+
+def cache_hit(name):
+    with _lock:
+        _caches.setdefault(name, {"hits": 0, "misses": 0})["hits"] += 1
+
+
+def cache_miss(name):
+    with _lock:
+        _caches.setdefault(name, {"hits": 0, "misses": 0})["misses"] += 1
+
+
+## flask hooks
+
+def _before_request():
+    g.request_start = timer()
+    g.timings = {}
+    g.timing_order = []
+    g.observations = {}
+
+
+def _after_request(response):
+    if not hasattr(g, "request_start"):
+        return response
+
+    total = (timer() - g.request_start) * 1000.
+    rule = request.url_rule.rule if request.url_rule is not None else "<unmatched>"
+
+    header = ["%s;dur=%.2f" % (name, g.timings[name]) for name in g.timing_order]
+    header.append("total;dur=%.2f" % total)
+    response.headers["Server-Timing"] = ", ".join(header)
+
+    if not response.direct_passthrough:
+        g.observations.setdefault("payload_bytes", response.content_length)
+
+    with _lock:
+        metrics = _route_metrics(rule)
+        metrics["latency"].add(total)
+        for name in g.timing_order:
+            if name not in metrics["stages"]:
+                metrics["stages"][name] = RollingHistogram(buckets=LATENCY_BUCKETS_MS)
+            metrics["stages"][name].add(g.timings[name])
+        for name, value in g.observations.items():
+            if value is None:
+                continue
+            if name not in metrics["values"]:
+                metrics["values"][name] = RollingHistogram()
+            metrics["values"][name].add(value)
+
+    return response
+
+
+def metrics_snapshot():
+    with _lock:
+        routes = {}
+        for rule, metrics in _routes.items():
+            routes[rule] = {
+                "latency_ms": metrics["latency"].summary(),
+                "stages_ms": dict((k, v.summary()) for k, v in metrics["stages"].items()),
+                "values": dict((k, v.summary()) for k, v in metrics["values"].items())
+            }
+
+        caches = {}
+        for name, counts in _caches.items():
+            total = counts["hits"] + counts["misses"]
+            caches[name] = {
+                "hits": counts["hits"],
+                "misses": counts["misses"],
+                "hit_rate": counts["hits"] * 1.0 / total if total > 0 else None
+            }
+
+    return {"routes": routes, "caches": caches}
+
+
+def reset():
+    with _lock:
+        _routes.clear()
+        _caches.clear()
+
+
+def init_app(app):
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+
+    def metrics():
+        return app.response_class(json.dumps(metrics_snapshot()), mimetype="application/json")
+
+    app.add_url_rule("/metrics", "metrics", metrics)
+    return app
@@ -0,0 +1,92 @@
+import os
+import pickle
+
+## Column metadata discovery (type, min/max, distinct values) for the feature encoders.
+##
+## All columns are summarized with a single $group aggregation instead of two sorted
+## find_one queries per numeric/date column and a distinct() per string column. The
+## result is pickled next to the input data together with a fingerprint of the
+## collection, so a restarted worker can skip discovery while the data is unchanged.
+
+try:
+    STRING_TYPES = (str, unicode)
+    NUMBER_TYPES = (int, long, float)
+except NameError:
+    STRING_TYPES = (str,)
+    NUMBER_TYPES = (int, float)
+
+
+def fingerprint(collection, cols):
+    last = collection.find_one({}, {"_id": True}, sort=[("_id", -1)])
+    return {
+        "namespace": collection.full_name,
+        "count": collection.count(),
+        "last_id": str(last["_id"]) if last is not None else None,
+        "cols": list(cols)
+    }
+
+
+def column_types(collection, cols):
+    sample = collection.find_one({}, dict((key, True) for key in cols))
+    types = {}
+    if sample is None:
+        return types
+
+    for key in cols:
+        if key == "date":
+            types[key] = "date"
+        elif type(sample[key]) in NUMBER_TYPES:
+            types[key] = "number"
+        elif isinstance(sample[key], STRING_TYPES):
+            types[key] = "string"
+
+    return types
+
+
+def discover_meta(collection, cols):
+    types = column_types(collection, cols)
+    if len(types) == 0:
+        return {}
+
+    group = {"_id": None}
+    for key, kind in types.items():
+        if kind == "string":
+            group[key + "__values"] = {"$addToSet": "$" + key}
+        else:
+            group[key + "__min"] = {"$min": "$" + key}
+            group[key + "__max"] = {"$max": "$" + key}
+
+    summary = list(collection.aggregate([{"$group": group}]))[0]
+
+    meta = {}
+    for key, kind in types.items():
+        meta[key] = {"type": kind}
+        if kind == "string":
+            meta[key]["values"] = sorted(v for v in summary[key + "__values"] if v is not None)
+        else:
+            meta[key]["min"] = summary[key + "__min"]
+            meta[key]["max"] = summary[key + "__max"]
+
+    return meta
+
+
+def load_meta(collection, cols, cache_path=None):
+    """Returns (meta, cached) using the pickled metadata when the fingerprint matches."""
+    current = fingerprint(collection, cols)
+
+    if cache_path is not None and os.path.isfile(cache_path):
+        try:
+            with open(cache_path, "rb") as f:
+                cached = pickle.load(f)
+            if cached["fingerprint"] == current:
+                return cached["meta"], True
+        except Exception:
+            pass
+
+    meta = discover_meta(collection, cols)
+
+    if cache_path is not None and len(meta) > 0:
+        with open(cache_path, "wb") as f:
+            pickle.dump({"fingerprint": current, "meta": meta}, f, pickle.HIGHEST_PROTOCOL)
+
+    return meta, False
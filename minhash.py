@@ -0,0 +1,196 @@
+import re
+import threading
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+
+## Near-duplicate lookup over annotation texts with MinHash and LSH.
+##
+## Every distinct annotation is normalized (lower case, punctuation dropped) and cut into
+## character SHINGLE_SIZE-grams. Its MinHash signature has PERMUTATIONS values; split
+## into BANDS bands, each band is one LSH bucket key. Texts that share a bucket are
+## candidates, and candidates are kept when the exact Jaccard similarity of their
+## shingle sets reaches the threshold. A lookup touches only its BANDS buckets, so it
+## stays cheap as the vocabulary grows. With 32 bands of 4 rows, pairs at Jaccard 0.5
+## are found with probability ~0.87 and pairs at 0.8 almost surely. Merged groups are
+## rebuilt per threshold, so thresholds are rounded to MERGE_STEP and only the
+## MERGE_CACHE most recently used ones are kept.
+
+SHINGLE_SIZE = 4
+PERMUTATIONS = 128
+BANDS = 32
+THRESHOLD = 0.5
+MERGE_STEP = 0.01
+MERGE_CACHE = 8
+# largest prime below 2^32: (a * x + b) for 32-bit x, a and b stays inside uint64
+PRIME = 4294967291
+SEED = 1
+
+random_state = np.random.RandomState(SEED)
+A = random_state.randint(1, PRIME, size=PERMUTATIONS).astype(np.uint64)
+B = random_state.randint(0, PRIME, size=PERMUTATIONS).astype(np.uint64)
+
+
+def normalize(text):
+    return " ".join(re.sub(r"[^\w\s]", " ", text.lower(), flags=re.UNICODE).split())
+
+
+def shingles(text):
+    text = normalize(text)
+    if len(text) <= SHINGLE_SIZE:
+        return set([text])
+    return set(text[i:i + SHINGLE_SIZE] for i in range(0, len(text) - SHINGLE_SIZE + 1))
+
+
+def signature(shingle_set):
+    hashes = np.array([zlib.crc32(s.encode("utf-8")) & 0xffffffff for s in shingle_set], dtype=np.uint64)
+    return ((A[:, np.newaxis] * hashes[np.newaxis, :] + B[:, np.newaxis]) % PRIME).min(axis=1)
+
+
+def parse_threshold(value):
+    """`value` as a Jaccard threshold in (0, 1]; raises ValueError for anything else."""
+    if isinstance(value, bool):
+        raise ValueError("Threshold must be a number")
+    try:
+        threshold = float(value)
+    except TypeError:
+        raise ValueError("Threshold must be a number")
+    # NaN fails both comparisons
+    if not 0. < threshold <= 1.:
+        raise ValueError("Threshold must be in (0, 1]")
+    return threshold
+
+
+def jaccard(a, b):
+    if len(a) == 0 and len(b) == 0:
+        return 1.
+    return len(a & b) * 1.0 / len(a | b)
+
+
+class AnnotationIndex(object):
+    """LSH buckets over the distinct annotation texts, with optional counts per text."""
+
+    def __init__(self, counts=None):
+        self.texts = []
+        self.ids = {}
+        self.shingles = []
+        self.counts = {}
+        self.buckets = {}
+        self.representatives = OrderedDict()
+        self.lock = threading.Lock()
+        for text, count in (counts or {}).items():
+            self.add(text, count)
+
+    def __len__(self):
+        return len(self.texts)
+
+    def band_keys(self, sig):
+        rows = PERMUTATIONS // BANDS
+        return [(band, sig[band * rows:(band + 1) * rows].tobytes()) for band in range(0, BANDS)]
+
+    def add(self, text, count=1):
+        """Indexes a new annotation text (or adds to the count of a known one)."""
+        with self.lock:
+            self.counts[text] = self.counts.get(text, 0) + count
+            if text in self.ids:
+                return
+
+            shingle_set = shingles(text)
+            index = len(self.texts)
+            self.ids[text] = index
+            self.texts.append(text)
+            self.shingles.append(shingle_set)
+            for key in self.band_keys(signature(shingle_set)):
+                self.buckets.setdefault(key, []).append(index)
+            # merged groups depend on the whole vocabulary
+            self.representatives.clear()
+
+    def candidates(self, shingle_set):
+        found = set()
+        for key in self.band_keys(signature(shingle_set)):
+            found.update(self.buckets.get(key, []))
+        return found
+
+    def similar(self, text, threshold=THRESHOLD, k=None):
+        """Indexed annotations whose shingle sets are within `threshold` Jaccard of `text`."""
+        shingle_set = shingles(text)
+        with self.lock:
+            matches = []
+            for index in self.candidates(shingle_set):
+                similarity = jaccard(shingle_set, self.shingles[index])
+                if similarity >= threshold and self.texts[index] != text:
+                    matches.append({
+                        "annotation": self.texts[index],
+                        "similarity": similarity,
+                        "count": self.counts[self.texts[index]]
+                    })
+
+        matches.sort(key=lambda m: (-m["similarity"], m["annotation"]))
+        return matches if k is None else matches[:k]
+
+    def representative_map(self, threshold=THRESHOLD):
+        """text -> representative of its group of near-duplicates (the most frequent text).
+
+        Groups are the connected components of the verified candidate pairs, so a chain of
+        near-duplicates ends up in one group.
+        """
+        return self.merged(threshold)[0]
+
+    def merged_counts(self, threshold=THRESHOLD):
+        """representative -> summed count of its group."""
+        return self.merged(threshold)[1]
+
+    def merged(self, threshold):
+        step = max(1, int(round(threshold / MERGE_STEP)))
+        threshold = step * MERGE_STEP
+        with self.lock:
+            if step in self.representatives:
+                self.representatives[step] = self.representatives.pop(step)
+                return self.representatives[step]
+
+            parent = list(range(0, len(self.texts)))
+
+            def find(i):
+                while parent[i] != i:
+                    parent[i] = parent[parent[i]]
+                    i = parent[i]
+                return i
+
+            checked = set()
+            for members in self.buckets.values():
+                for x in range(0, len(members)):
+                    for y in range(x + 1, len(members)):
+                        pair = (members[x], members[y])
+                        if pair in checked:
+                            continue
+                        checked.add(pair)
+                        if jaccard(self.shingles[pair[0]], self.shingles[pair[1]]) >= threshold:
+                            parent[find(pair[0])] = find(pair[1])
+
+            best = {}
+            for index, text in enumerate(self.texts):
+                root = find(index)
+                if root not in best or (-self.counts[text], text) < (-self.counts[best[root]], best[root]):
+                    best[root] = text
+
+            mapping = {}
+            totals = {}
+            for index, text in enumerate(self.texts):
+                mapping[text] = best[find(index)]
+                totals[mapping[text]] = totals.get(mapping[text], 0) + self.counts[text]
+
+            self.representatives[step] = (mapping, totals)
+            while len(self.representatives) > MERGE_CACHE:
+                self.representatives.popitem(last=False)
+            return mapping, totals
+
+
+def merge(texts, representative):
+    """The distinct representatives of `texts`, in first-seen order."""
+    merged = []
+    for text in texts:
+        text = representative.get(text, text)
+        if text not in merged:
+            merged.append(text)
+    return merged
@@ -1,4 +1,5 @@
 import json, pymongo
+import columnar
 from datetime import datetime
 from titlecase import titlecase
 
@@ -25,6 +26,7 @@ mongo_client = pymongo.MongoClient()
 mongo_collection = mongo_client.building.permit
 mongo_collection.drop()  # throw out what's there
 
+allData = []
 
 for data in data_json:
     wData = {}
@@ -72,6 +74,7 @@ for data in data_json:
             wData[key] = title_case(wData[key])
 
     mongo_collection.insert_one(wData)
+    allData.append(wData)
 
 
 # create index by specific columns
@@ -79,6 +82,9 @@ mongo_collection.create_index('date')
 mongo_collection.create_index('description')
 mongo_collection.create_index('state')
 
+# columnar snapshot the app memory-maps at startup (insert_one() added the _ids)
+columnar.write("input/building-columns", allData, "building.permit")
+
 
 # close connection
 mongo_client.close()
\ No newline at end of file
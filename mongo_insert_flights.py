@@ -1,4 +1,5 @@
 import json, pymongo
+import columnar
 from datetime import datetime
 from titlecase import titlecase
 import pandas as pd
@@ -107,6 +108,9 @@ mongo_collection.create_index('dep_delay')
 mongo_collection.create_index('arr_delay')
 mongo_collection.create_index('destination')
 
+# columnar snapshot the app memory-maps at startup (insert() added the _ids)
+columnar.write("input/flights-columns", allData, "flights.delay")
+
 
 # close connection
 mongo_client.close()
\ No newline at end of file
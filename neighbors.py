@@ -0,0 +1,219 @@
+import threading
+
+import numpy as np
+from scipy.spatial import cKDTree, distance
+
+import encoding
+
+## Nearest-neighbor index over the startup feature matrix, built on the first /neighbors
+## request.
+##
+## Low-dimensional feature spaces get a KD-tree (euclidean, cityblock, chebyshev). The
+## one-hot spaces are usually too wide for a tree and are searched by brute force. Code
+## encoded features (see encoding.py) stay as codes: a query is one vector of the one-hot
+## space and its distances to CHUNK_ROWS rows at a time come from encoding.distances_to.
+## Dense matrices are searched over a float32 copy: euclidean from precomputed row norms,
+## cosine and correlation from normalized (and centered) rows, each one matrix-vector
+## product per query, other metrics with chunked cdist. The k best are picked with
+## np.argpartition. Requests are validated first: k in [1, MAX_K], a measure of METRICS
+## and row indices in range, each one ValueError otherwise.
+
+KDTREE_MAX_DIMENSIONS = 16
+KDTREE_METRICS = {"euclidean": 2, "cityblock": 1, "chebyshev": np.inf}
+CHUNK_ROWS = 65536
+DEFAULT_K = 10
+MAX_K = 1000
+# served without expanding code encoded features
+METRICS = encoding.CODE_METRICS
+COMBINE = ["centroid", "each"]
+
+
+def normalize(matrix):
+    norms = np.sqrt((matrix * matrix).sum(axis=1))
+    norms[norms == 0] = 1.
+    return matrix / norms[:, np.newaxis]
+
+
+class NeighborIndex(object):
+
+    def __init__(self, features):
+        if isinstance(features, encoding.Encoded):
+            self.features = features
+            self.rows, self.dimensions = len(features), features.dimensions
+        else:
+            self.features = np.ascontiguousarray(features, dtype=np.float32)
+            self.rows, self.dimensions = self.features.shape
+        self.tree = None
+        if self.dimensions <= KDTREE_MAX_DIMENSIONS:
+            # narrow enough that the expanded coordinates cost no more than the codes
+            self.tree = cKDTree(encoding.as_dense(self.features))
+
+        # derived matrices are built the first time a metric is queried
+        self.derived = {}
+        self.lock = threading.Lock()
+
+    @property
+    def encoded(self):
+        return isinstance(self.features, encoding.Encoded)
+
+    @property
+    def nbytes(self):
+        # code encoded features are the snapshot's, a dense copy is the index's own
+        own = 0 if self.encoded else self.features.nbytes
+        return own + sum(m.nbytes for m in self.derived.values())
+
+    def matrix(self, name):
+        with self.lock:
+            if name not in self.derived:
+                if name == "sqnorms":
+                    self.derived[name] = (self.features * self.features).sum(axis=1)
+                elif name == "normalized":
+                    self.derived[name] = normalize(self.features)
+                elif name == "centered":
+                    self.derived[name] = normalize(self.features - self.features.mean(axis=1)[:, np.newaxis])
+            return self.derived[name]
+
+    def distances(self, query, metric):
+        """Distances from one query vector to every row."""
+        if self.encoded:
+            result = np.empty(self.rows)
+            for start in range(0, self.rows, CHUNK_ROWS):
+                result[start:start + CHUNK_ROWS] = encoding.distances_to(self.features[start:start + CHUNK_ROWS], query, metric)
+            return result
+
+        query = np.asarray(query, dtype=np.float32)
+        if metric == "euclidean":
+            squared = self.matrix("sqnorms") - 2. * self.features.dot(query) + query.dot(query)
+            return np.sqrt(np.maximum(squared, 0.))
+        if metric == "cosine":
+            return 1. - self.matrix("normalized").dot(normalize(query[np.newaxis, :])[0])
+        if metric == "correlation":
+            centered = query - query.mean()
+            return 1. - self.matrix("centered").dot(normalize(centered[np.newaxis, :])[0])
+
+        result = np.empty(self.rows)
+        for start in range(0, self.rows, CHUNK_ROWS):
+            chunk = self.features[start:start + CHUNK_ROWS]
+            result[start:start + CHUNK_ROWS] = distance.cdist(query[np.newaxis, :], chunk, metric)[0]
+        return result
+
+    def query(self, query, k, metric="euclidean", exclude=()):
+        """Returns the k nearest rows to `query` as (indices, distances), nearest first."""
+        exclude = set(exclude)
+        wanted = min(self.rows, k + len(exclude))
+        if wanted == 0:
+            return [], []
+
+        if self.tree is not None and metric in KDTREE_METRICS:
+            found, found_indices = self.tree.query(np.asarray(query, dtype=float), k=wanted, p=KDTREE_METRICS[metric])
+            found = np.atleast_1d(found)
+            found_indices = np.atleast_1d(found_indices)
+        else:
+            all_distances = self.distances(query, metric)
+            if wanted < self.rows:
+                found_indices = np.argpartition(all_distances, wanted - 1)[:wanted]
+            else:
+                found_indices = np.arange(self.rows)
+            found_indices = found_indices[np.argsort(all_distances[found_indices], kind="mergesort")]
+            found = all_distances[found_indices]
+
+        indices = []
+        distances = []
+        for index, value in zip(found_indices, found):
+            if int(index) in exclude:
+                continue
+            indices.append(int(index))
+            distances.append(float(value))
+            if len(indices) == k:
+                break
+        return indices, distances
+
+    def vector(self, index):
+        """Row `index` as a query vector."""
+        if self.encoded:
+            return self.features[index:index + 1].to_dense()[0]
+        return self.features[index]
+
+    def centroid(self, indices):
+        if self.encoded:
+            return self.features.mean(list(indices))
+        return self.features[list(indices)].mean(axis=0)
+
+
+def parse_k(value):
+    """`value` as a neighbor count in [1, MAX_K]; raises ValueError for anything else."""
+    if isinstance(value, (bool, float)):
+        raise ValueError("k must be an integer")
+    try:
+        k = int(value)
+    except TypeError:
+        raise ValueError("k must be an integer")
+    if not 1 <= k <= MAX_K:
+        raise ValueError("k must be between 1 and " + str(MAX_K))
+    return k
+
+
+def parse_measure(value):
+    if value not in METRICS:
+        raise ValueError("measure must be one of " + ", ".join(METRICS))
+    return value
+
+
+def parse_index(value, rows):
+    """`value` as a row index in [0, rows); raises ValueError for anything else."""
+    if isinstance(value, (bool, float)):
+        raise ValueError("indices must be integers")
+    try:
+        index = int(value)
+    except TypeError:
+        raise ValueError("indices must be integers")
+    if not 0 <= index < rows:
+        raise ValueError("index " + str(index) + " is out of range")
+    return index
+
+
+def neighbor_list(indices, distances):
+    return [{"index": i, "distance": d} for i, d in zip(indices, distances)]
+
+
+def answer(index, req, annotation_members=None):
+    """Runs a /neighbors request against `index`.
+
+    Accepted forms: {"index": i}, {"indices": [...], "combine": "each" | "centroid"} and
+    {"annotation": text}, with optional "k" (default 10) and "measure" (default euclidean).
+    Raises ValueError for invalid values.
+    """
+    k = parse_k(req.get("k", DEFAULT_K))
+    measure = parse_measure(req.get("measure") or "euclidean")
+
+    if req.get("index") is not None:
+        i = parse_index(req["index"], index.rows)
+        found = index.query(index.vector(i), k, measure, exclude=[i])
+        return {"neighbors": neighbor_list(*found)}
+
+    if req.get("annotation") is not None:
+        if not isinstance(req["annotation"], basestring):
+            raise ValueError("annotation must be a string")
+        members = annotation_members(req["annotation"]) if annotation_members is not None else []
+        if len(members) == 0:
+            return None
+        found = index.query(index.centroid(members), k, measure)
+        return {"neighbors": neighbor_list(*found), "members": len(members)}
+
+    if not isinstance(req.get("indices", []), list):
+        raise ValueError("indices must be a list")
+    indices = [parse_index(i, index.rows) for i in req.get("indices", [])]
+    if len(indices) == 0:
+        return None
+
+    combine = req.get("combine", "centroid")
+    if combine not in COMBINE:
+        raise ValueError("combine must be one of " + ", ".join(COMBINE))
+    if combine == "each":
+        results = []
+        for i in indices:
+            results.append({"index": i, "neighbors": neighbor_list(*index.query(index.vector(i), k, measure, exclude=[i]))})
+        return {"results": results}
+
+    found = index.query(index.centroid(indices), k, measure, exclude=indices)
+    return {"neighbors": neighbor_list(*found)}
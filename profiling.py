@@ -0,0 +1,156 @@
+import os
+import sys
+import json
+import time
+import uuid
+import threading
+from collections import defaultdict
+
+from flask import g, request
+
+## Opt-in sampling profiler for individual requests.
+##
+## A request is profiled when its route is listed in PROFILE_ROUTES, or when it carries
+## an `X-Profile: 1` header and PROFILE_HEADER is enabled (off by default, so clients
+## can't turn the profiler on unless the deployment allows it). The handler's thread is
+## sampled from a background thread; the collapsed stacks (flamegraph.pl / speedscope
+## compatible) and a top-N hot-function summary are written to PROFILE_DIR, tagged with
+## the selection size, focus and measure of the request. When neither switch is set the
+## cost is a route lookup per request.
+
+PROFILE_HEADER = "X-Profile"
+DEFAULT_CONFIG = {
+    "PROFILE_DIR": "profiles",
+    "PROFILE_ROUTES": [],
+    "PROFILE_HEADER": False,
+    "PROFILE_INTERVAL": 0.001,
+    "PROFILE_TOP": 25
+}
+
+
+class Sampler(threading.Thread):
+    """Samples the stack of one thread at a fixed interval until stopped."""
+
+    def __init__(self, thread_id, interval):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = defaultdict(int)
+        self.samples = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append("%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                    frame = frame.f_back
+                self.stacks[tuple(reversed(stack))] += 1
+                self.samples += 1
+            time.sleep(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def collapsed(stacks):
+    lines = []
+    for stack, count in sorted(stacks.items(), key=lambda x: -x[1]):
+        lines.append(";".join(stack) + " " + str(count))
+    return "\n".join(lines) + "\n"
+
+
+def top_functions(stacks, n):
+    own = defaultdict(int)
+    total = defaultdict(int)
+    for stack, count in stacks.items():
+        own[stack[-1]] += count
+        for name in set(stack):
+            total[name] += count
+
+    ranked = sorted(total.keys(), key=lambda name: (-own[name], -total[name]))
+    return [(name, own[name], total[name]) for name in ranked[:n]]
+
+
+def request_tags():
+    body = request.get_json(silent=True)
+    tags = {"route": request.url_rule.rule if request.url_rule is not None else request.path}
+    if isinstance(body, dict):
+        if isinstance(body.get("indices"), list):
+            tags["selection"] = len(body["indices"])
+        for key in ["focus", "measure", "cols"]:
+            if key in body:
+                tags[key] = body[key]
+    return tags
+
+
+def write_profile(directory, sampler, tags, elapsed, top):
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    name = "%s-%s" % (time.strftime("%Y%m%d-%H%M%S"), tags["route"].strip("/").replace("/", "_") or "index")
+    if "selection" in tags:
+        name += "-n" + str(tags["selection"])
+    # requests of one route within the same second would overwrite each other
+    name += "-" + uuid.uuid4().hex[:8]
+    base = os.path.join(directory, name)
+
+    with open(base + ".collapsed", "w") as f:
+        f.write(collapsed(sampler.stacks))
+
+    with open(base + ".txt", "w") as f:
+        f.write("# " + json.dumps(tags, sort_keys=True) + "\n")
+        f.write("# %d samples, %.1f ms wall time\n" % (sampler.samples, elapsed * 1000.))
+        f.write("%8s %8s  %s\n" % ("self", "total", "function"))
+        for name, own, total in top_functions(sampler.stacks, top):
+            f.write("%8d %8d  %s\n" % (own, total, name))
+
+    return base
+
+
+## flask hooks
+
+def _wants_profile(app):
+    if request.url_rule is not None and request.url_rule.rule in app.config["PROFILE_ROUTES"]:
+        return True
+    return app.config["PROFILE_HEADER"] and request.headers.get(PROFILE_HEADER) == "1"
+
+
+def init_app(app):
+    for key, value in DEFAULT_CONFIG.items():
+        app.config.setdefault(key, value)
+
+    @app.before_request
+    def start_profile():
+        if not _wants_profile(app):
+            return
+        g.profile_start = time.time()
+        g.profile_sampler = Sampler(threading.current_thread().ident, app.config["PROFILE_INTERVAL"])
+        g.profile_sampler.start()
+
+    @app.after_request
+    def stop_profile(response):
+        sampler = getattr(g, "profile_sampler", None)
+        if sampler is None:
+            return response
+        g.profile_sampler = None
+        sampler.stop()
+
+        base = write_profile(app.config["PROFILE_DIR"], sampler, request_tags(),
+                             time.time() - g.profile_start, app.config["PROFILE_TOP"])
+        response.headers["X-Profile-File"] = os.path.basename(base)
+        return response
+
+    @app.teardown_request
+    def abandon_profile(exc):
+        # the handler raised, after_request never ran; don't leave the sampler spinning
+        sampler = getattr(g, "profile_sampler", None)
+        if sampler is not None:
+            sampler.stop()
+
+    return app
@@ -9,6 +9,9 @@ function AnnotationBinner(options) {
     _self.visuals = visuals;
     _self.COLS = [ "dep_delay", "origin", "destination", "arr_delay", "distance"];
     _self.measures = ["cosine", "euclidean", "correlation", "chebyshev", "canberra"]
+
+    // identifies this page to the server so consecutive orderings can be updated incrementally
+    _self.session = Math.random().toString(36).substr(2) + Date.now().toString(36);
 }
 
 //call this function right after every interaction to update the data source for the annotations
@@ -25,7 +28,7 @@ AnnotationBinner.prototype.extract = function () {
     });
 };
 
-AnnotationBinner.prototype.group_order = function (returnFunction, cols, focus, measure) {
+AnnotationBinner.prototype.group_order = function (returnFunction, cols, focus, measure, view) {
 
     var _self = this;
 
@@ -33,17 +36,24 @@ AnnotationBinner.prototype.group_order = function (returnFunction, cols, focus,
     focus = focus ? focus : _self.COLS;
 
     // request server for the ordering
+    // charts share the session; view keeps one chart's requests from replacing another's
     $.ajax({
         type: "POST",
         contentType: 'application/json',
-        url: "/order",
-        data: JSON.stringify({indices: _self.indices, focus: focus, cols: cols, measure: measure}),
+        url: "order",
+        data: JSON.stringify({indices: _self.indices, focus: focus, cols: cols, measure: measure, session: _self.session, view: view}),
         success: function (data) {
             // data is an array of groups of
             // {key, value, array[{index, score}], annotations[{annotation, [min, max score], pointsIndices};
             // score higher is outliers, lower is for centered
             returnFunction(data);
         },
+        error: function (xhr) {
+            // superseded by a newer ordering of the same chart, which renders instead
+            if (xhr.status == 409 && xhr.responseJSON && xhr.responseJSON.error == "superseded")
+                return;
+            console.log("Ordering annotations failed: " + xhr.status + " " + xhr.statusText);
+        },
         dataType: 'json'
     });
 
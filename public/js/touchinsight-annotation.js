@@ -67,7 +67,7 @@ AnnotationManager.prototype.sendtoServer = function () {
     $.ajax({
         type: "POST",
         contentType: 'application/json',
-        url: "http://localhost:3000/data",
+        url: "data",
         data: JSON.stringify(allAnnotations),
         success: function (data) {
             console.log("Annotations processed successfully by the server");
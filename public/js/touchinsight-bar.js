@@ -193,7 +193,7 @@ function BarChart(options) {
 
         // query server
         if (!DONT_ANNOTATION_GROUPS)
-            annotationBinner.group_order(addAnnotationIcons, cols, focus, measure);
+            annotationBinner.group_order(addAnnotationIcons, cols, focus, measure, parentId);
     }
 
     function showAnnotation(d, i) {
@@ -671,7 +671,7 @@ function BarChart(options) {
 
 
             if (!DONT_ANNOTATION_GROUPS)
-                annotationBinner.group_order(addAnnotationIcons, cols, focus, measure);
+                annotationBinner.group_order(addAnnotationIcons, cols, focus, measure, parentId);
         });
     }
 
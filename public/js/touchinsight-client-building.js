@@ -94,7 +94,7 @@ function getDatafromQuery(queryList) {
     $.ajax({
         type: "POST",
         contentType: 'application/json',
-        url: "http://localhost:3000/data",
+        url: "data",
         data: JSON.stringify({}),
         success: function (data) {
             handleDatafromQuery(data["content"]);
@@ -203,7 +203,7 @@ function getDatafromQuery() {
     $.ajax({
         type: "POST",
         contentType: 'application/json',
-        url: "/data",
+        url: "data",
         data: JSON.stringify({}),
         success: function (data) {
             handleDatafromQuery(data["content"]);
@@ -180,7 +180,7 @@ function LineChart(options) {
 
         // query server
         if (!DONT_ANNOTATION_GROUPS)
-            annotationBinner.group_order(addAnnotationIcons, cols, focus, measure);
+            annotationBinner.group_order(addAnnotationIcons, cols, focus, measure, parentId);
     }
 
     function showAnnotation(d, i) {
@@ -563,7 +563,7 @@ function LineChart(options) {
                 .text(cols[0]);
 
             if (!DONT_ANNOTATION_GROUPS)
-                annotationBinner.group_order(addAnnotationIcons, cols, focus, measure);
+                annotationBinner.group_order(addAnnotationIcons, cols, focus, measure, parentId);
         });
     }
 
@@ -170,7 +170,7 @@ QueryManager.prototype.retrieveData = function () {
     $.ajax({
         type: "POST",
         contentType: 'application/json',
-        url: "http://localhost:3000/data",
+        url: "data",
         data: JSON.stringify(query),
         success: function (data) {
             console.log(data["content"]);
@@ -175,7 +175,7 @@ function ScatterPlot(options) {
 
         // query server
         if (!DONT_ANNOTATION_GROUPS)
-            annotationBinner.group_order(addAnnotationIcons, cols, focus, measure);
+            annotationBinner.group_order(addAnnotationIcons, cols, focus, measure, parentId);
     }
 
     function showAnnotation(d, i) {
@@ -877,7 +877,7 @@ function ScatterPlot(options) {
                 .text(cols[1]);
 
             if (!DONT_ANNOTATION_GROUPS)
-                annotationBinner.group_order(addAnnotationIcons, cols, focus, measure);
+                annotationBinner.group_order(addAnnotationIcons, cols, focus, measure, parentId);
         });
 
     }
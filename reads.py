@@ -0,0 +1,66 @@
+import threading
+
+import bson
+import pymongo
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+
+## Mongo reads shared by the apps and the dataset registry.
+##
+## Bulk loads ask for large batches (fewer getMore round trips) and project out the
+## fields nobody reads, _id in particular, so the driver builds less per document.
+## Responses the client accepts as BSON skip decoding entirely: documents come back as
+## RawBSONDocument and their bytes are passed through as they are. All reads go through
+## one MongoClient per URI, and with it one connection pool.
+
+LOAD_BATCH_SIZE = 10000
+QUERY_BATCH_SIZE = 2000
+POOL_SIZE = 100
+RAW_OPTIONS = CodecOptions(document_class=RawBSONDocument)
+
+clients = {}
+clients_lock = threading.Lock()
+
+
+def shared_client(uri=None, pool_size=POOL_SIZE):
+    """The process-wide MongoClient for `uri`, created on first use."""
+    with clients_lock:
+        if uri not in clients:
+            clients[uri] = pymongo.MongoClient(uri, maxPoolSize=pool_size, connect=False)
+        return clients[uri]
+
+
+def projection(fields=None, with_id=False):
+    if fields is None:
+        return None if with_id else {"_id": False}
+
+    result = dict((field, True) for field in fields)
+    if not with_id:
+        result["_id"] = False
+    return result
+
+
+def find(collection, query, fields=None, with_id=False, batch_size=QUERY_BATCH_SIZE):
+    return collection.find(query, projection(fields, with_id)).batch_size(batch_size)
+
+
+def load(collection, query, fields=None, with_id=False):
+    """Every matching document, read in LOAD_BATCH_SIZE batches."""
+    return list(find(collection, query, fields, with_id, LOAD_BATCH_SIZE))
+
+
+def raw(collection, query, fields=None, with_id=False):
+    """The matching documents as one BSON byte string, without decoding them."""
+    try:
+        raw_collection = collection.with_options(codec_options=RAW_OPTIONS)
+    except NotImplementedError:
+        # in-memory stand-ins (mongomock) only return dicts; those are encoded again
+        raw_collection = collection
+
+    chunks = []
+    for document in find(raw_collection, query, fields, with_id):
+        if isinstance(document, RawBSONDocument):
+            chunks.append(document.raw)
+        else:
+            chunks.append(bson.BSON.encode(document))
+    return b"".join(chunks)
@@ -0,0 +1,235 @@
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+import urllib2
+from Queue import Queue
+from datetime import datetime
+from timeit import default_timer as timer
+
+import benchmark
+import capture
+from instrumentation import RollingHistogram
+
+## Replays captured dashboard traffic and reports tail latency.
+##
+## Reads a capture file written by capture.py and re-issues its requests with their
+## original spacing (divided by --speed, or back to back with --speed 0), each one
+## --multiply times to stand in for that many analysts, from --concurrency worker
+## threads. Every copy runs as its own analyst: requests carrying a session get a
+## distinct session per copy, so copies are neither coalesced nor share score caches,
+## and copies after the first go out up to --jitter seconds later. The target is a running server (--url) or an app loaded in-process on
+## synthetic data in a mongomock collection (--local flights|building, --rows N);
+## captured indices must exist in the target. Prints per-endpoint p50/p95/p99 latency,
+## throughput and error rates as JSON.
+##
+##   CAPTURE_FILE=traffic.jsonl python app_flights.py
+##   python replay.py traffic.jsonl --url http://localhost:3000 --multiply 4 --concurrency 16
+
+DEFAULT_CONCURRENCY = 8
+DEFAULT_LOCAL_ROWS = 2000
+LOCAL_APPS = {
+    "flights": ("app_flights", benchmark.generate_flights),
+    "building": ("app_building", benchmark.generate_permits)
+}
+
+
+## targets: send(entry) -> status
+
+class HttpTarget(object):
+
+    def __init__(self, url):
+        self.url = url.rstrip("/")
+
+    def send(self, entry):
+        headers = {"Content-Type": "application/json"}
+        if entry.get("accept"):
+            headers["Accept"] = entry["accept"]
+        body = entry["body"].encode("utf-8") if entry["method"] == "POST" else None
+        try:
+            response = urllib2.urlopen(urllib2.Request(self.url + entry["path"], body, headers))
+            response.read()
+            return response.getcode()
+        except urllib2.HTTPError, e:
+            return e.code
+
+
+class LocalTarget(object):
+
+    def __init__(self, dataset, rows, seed):
+        name, generate = LOCAL_APPS[dataset]
+        app_module = __import__(name)
+        benchmark.use_collection(app_module.dataset, generate(rows, seed=seed)).load()
+        self.app = app_module.app
+
+    def send(self, entry):
+        headers = {"Accept": entry["accept"]} if entry.get("accept") else {}
+        response = self.app.test_client().open(entry["path"], method=entry["method"], data=entry["body"],
+                                               content_type="application/json", headers=headers)
+        response.get_data()
+        return response.status_code
+
+
+## replay
+
+def as_copy(entry, copy):
+    """`entry` as sent by analyst number `copy`: its session, if any, gets that number."""
+    if copy == 0 or entry["method"] != "POST":
+        return entry
+    try:
+        body = json.loads(entry["body"])
+    except ValueError:
+        return entry
+    if not isinstance(body, dict) or body.get("session") is None:
+        return entry
+
+    body["session"] = "%s-%d" % (body["session"], copy)
+    return dict(entry, body=json.dumps(body))
+
+
+def schedule(entries, speed, multiply, jitter=0., seed=0):
+    """(offset in seconds, entry) in send order."""
+    if len(entries) == 0:
+        return []
+    rng = random.Random(seed)
+    first = entries[0]["time"]
+    planned = []
+    for entry in entries:
+        offset = (entry["time"] - first) / speed if speed > 0 else 0.
+        for copy in range(0, multiply):
+            delay = rng.uniform(0., jitter) if copy > 0 and jitter > 0 else 0.
+            planned.append((offset + delay, as_copy(entry, copy)))
+    planned.sort(key=lambda item: item[0])
+    return planned
+
+
+def replay(target, planned, concurrency):
+    results = []
+    results_lock = threading.Lock()
+    queue = Queue()
+    for item in planned:
+        queue.put(item)
+
+    start = timer()
+
+    def worker():
+        while True:
+            item = queue.get()
+            if item is None:
+                return
+            offset, entry = item
+            delay = start + offset - timer()
+            if delay > 0:
+                time.sleep(delay)
+
+            sent = timer()
+            try:
+                status = target.send(entry)
+                error = None
+            except Exception, e:
+                status = None
+                error = str(e)
+            done = timer()
+
+            with results_lock:
+                results.append({
+                    "path": entry["path"],
+                    "status": status,
+                    "error": error,
+                    "ms": (done - sent) * 1000.,
+                    "lag_ms": max(0., sent - start - offset) * 1000.
+                })
+
+    threads = [threading.Thread(target=worker) for i in range(0, concurrency)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        queue.put(None)
+    for thread in threads:
+        thread.join()
+
+    return results, timer() - start
+
+
+def summarize(results, seconds):
+    groups = {}
+    for result in results:
+        groups.setdefault(result["path"], []).append(result)
+    groups["all"] = results
+
+    report = {}
+    for path, group in groups.items():
+        latency = RollingHistogram(window=None)
+        lag = RollingHistogram(window=None)
+        errors = 0
+        statuses = {}
+        for result in group:
+            latency.add(result["ms"])
+            lag.add(result["lag_ms"])
+            key = str(result["status"]) if result["error"] is None else "exception"
+            statuses[key] = statuses.get(key, 0) + 1
+            if result["error"] is not None or result["status"] >= 400:
+                errors += 1
+
+        report[path] = {
+            "requests": len(group),
+            "errors": errors,
+            "error_rate": errors * 1.0 / len(group),
+            "statuses": statuses,
+            "throughput_rps": len(group) / seconds if seconds > 0 else None,
+            "latency_ms": latency.summary(),
+            # how late requests went out against the schedule; grows when the workers saturate
+            "lag_ms": lag.summary()
+        }
+    return report
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Replay captured dashboard traffic and report tail latency.")
+    parser.add_argument("capture", help="capture file written with CAPTURE_FILE set")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--url", help="base URL of a running server, e.g. http://localhost:3000")
+    target.add_argument("--local", choices=sorted(LOCAL_APPS.keys()), help="load this app in-process on synthetic data")
+    parser.add_argument("--rows", type=int, default=DEFAULT_LOCAL_ROWS, help="synthetic rows for --local")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--speed", type=float, default=1., help="rate multiplier; 0 sends back to back")
+    parser.add_argument("--multiply", type=int, default=1, help="send every captured request this many times")
+    parser.add_argument("--jitter", type=float, default=0., help="delay copies by up to this many seconds")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY, help="worker threads")
+    parser.add_argument("--output", default=None, help="write JSON results to this file instead of stdout")
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = parse_args(argv)
+    entries = capture.read(args.capture)
+    target = HttpTarget(args.url) if args.url is not None else LocalTarget(args.local, args.rows, args.seed)
+
+    results, seconds = replay(target, schedule(entries, args.speed, args.multiply, args.jitter, args.seed), args.concurrency)
+    record = {
+        "capture": args.capture,
+        "target": args.url or args.local,
+        "captured": len(entries),
+        "speed": args.speed,
+        "multiply": args.multiply,
+        "jitter": args.jitter,
+        "concurrency": args.concurrency,
+        "seconds": seconds,
+        "revision": benchmark.git_revision(),
+        "timestamp": datetime.utcnow().isoformat(),
+        "endpoints": summarize(results, seconds)
+    }
+
+    result = json.dumps(record, indent=2, sort_keys=True)
+    if args.output is None:
+        print(result)
+    else:
+        with open(args.output, "w") as f:
+            f.write(result + "\n")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
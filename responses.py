@@ -0,0 +1,147 @@
+import re
+import json
+import zlib
+import uuid
+from datetime import datetime
+
+import numpy as np
+from flask import request
+
+from assets import accepted_encodings
+from instrumentation import stage, observe
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+## JSON encoding and on-the-fly compression for the API endpoints.
+##
+## The stdlib encoder writes the response; finite numeric NumPy arrays (distance
+## matrices, score vectors) are left out as placeholders and their text is written one
+## row at a time and spliced in, so they never become one nested list of Python floats.
+## Other NumPy values are converted as they are met.
+## Numeric payloads (/order, /distance and /order/members: lists, dicts, numbers and
+## float64/int64 arrays) go through ujson's C encoder instead when it is installed,
+## with floats written to UJSON_PRECISION decimal places. ujson writes datetimes as
+## epoch seconds, so payloads with documents always take the stdlib path; anything
+## ujson refuses (NaN, float32, NumPy scalars other than int64) falls back to it too.
+## Bodies over MIN_COMPRESS_BYTES are compressed with zstd or gzip, whichever the client
+## accepts (zstd preferred, and only with the zstandard package installed).
+
+MIN_COMPRESS_BYTES = 1024
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+# ujson's maximum
+UJSON_PRECISION = 15
+
+# what a spliced array is encoded as until its text replaces it; the random tag keeps
+# strings in the data from passing for one
+ARRAY_PLACEHOLDER = u"\0ndarray-%s-%d\0"
+ARRAY_PATTERN = r'"\\u0000ndarray-%s-(\d+)\\u0000"'
+
+
+def numpy_default(obj):
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, set):
+        return list(obj)
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    raise TypeError(repr(obj) + " is not JSON serializable")
+
+
+def spliceable(array):
+    # NaN and infinities are written as the stdlib writes them, through tolist()
+    if array.dtype.kind in "iu":
+        return True
+    return array.dtype.kind == "f" and bool(np.isfinite(array).all())
+
+
+def array_text(array):
+    """The JSON text json.dumps(array.tolist()) gives, built one row at a time."""
+    if array.ndim > 1:
+        return "[" + ", ".join(array_text(row) for row in array) + "]"
+    format_value = repr if array.dtype.kind == "f" else str
+    return "[" + ", ".join(map(format_value, array.tolist())) + "]"
+
+
+def dumps(obj):
+    arrays = []
+    tag = uuid.uuid4().hex
+
+    def default(value):
+        if isinstance(value, np.ndarray) and value.ndim > 0 and spliceable(value):
+            arrays.append(value)
+            return ARRAY_PLACEHOLDER % (tag, len(arrays) - 1)
+        return numpy_default(value)
+
+    body = json.dumps(obj, default=default)
+    if len(arrays) == 0:
+        return body
+
+    parts = re.split(ARRAY_PATTERN % tag, body)
+    # odd parts are the array numbers the pattern captured
+    for i in range(1, len(parts), 2):
+        parts[i] = array_text(arrays[int(parts[i])])
+    return "".join(parts)
+
+
+def numeric_dumps(obj):
+    """dumps() for payloads without datetimes, through ujson when it is installed."""
+    if ujson is not None:
+        try:
+            return ujson.dumps(obj, double_precision=UJSON_PRECISION, escape_forward_slashes=False)
+        except (OverflowError, TypeError):
+            pass
+    return dumps(obj)
+
+
+def compress(body, encoding):
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(body)
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(body) + compressor.flush()
+
+
+def choose_encoding(accept_encoding):
+    accepted = accepted_encodings(accept_encoding)
+    if zstandard is not None and accepted.get("zstd", 0.) > 0.:
+        return "zstd"
+    if accepted.get("gzip", accepted.get("*", 0.)) > 0.:
+        return "gzip"
+    return "identity"
+
+
+def accepts(mimetype):
+    """True when the client prefers `mimetype` over JSON."""
+    return request.accept_mimetypes.best_match(["application/json", mimetype]) == mimetype
+
+
+def json_response(app, obj, status=200, numeric=False):
+    with stage("serialize"):
+        body = numeric_dumps(obj) if numeric else dumps(obj)
+    if not isinstance(body, bytes):
+        body = body.encode("utf-8")
+    observe("json_bytes", len(body))
+
+    return body_response(app, body, "application/json", status)
+
+
+def body_response(app, body, mimetype, status=200):
+    headers = {"Vary": "Accept-Encoding"}
+    if len(body) >= MIN_COMPRESS_BYTES:
+        encoding = choose_encoding(request.headers.get("Accept-Encoding", ""))
+        if encoding != "identity":
+            with stage("compress"):
+                body = compress(body, encoding)
+            headers["Content-Encoding"] = encoding
+
+    return app.response_class(body, status=status, mimetype=mimetype, headers=headers)
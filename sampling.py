@@ -0,0 +1,99 @@
+import heapq
+import random
+
+## Stratified samples of large /data results.
+##
+## The matching documents are read once from the cursor. Every document gets a random
+## key and each stratum keeps the max_rows documents with the smallest keys, so the
+## counts are exact and, whatever the final allocation, the n smallest keys of a stratum
+## are a uniform sample of it. Strata get max_rows split in proportion to their counts,
+## at least one row each; every sampled row carries the weight count / sampled of its
+## stratum, so weighted sums estimate the totals of the full result. Results within the
+## budget come back whole, in cursor order. Keys come from a seeded generator: the same
+## query gives the same sample, and views don't flicker when they are redrawn.
+
+DEFAULT_SEED = 0
+EMPTY_DATUM = "None"
+
+
+def stratum_of(column, annotated=False):
+    """Stratum of a document: its value of `column`, or whether that annotation list is non-empty."""
+    if column is None:
+        return lambda document: "all"
+    if annotated:
+        return lambda document: "annotated" if len(document.get(column) or []) > 0 else "unannotated"
+    return lambda document: unicode(document.get(column, EMPTY_DATUM))
+
+
+def allocate(counts, max_rows):
+    """Rows per stratum: proportional to counts, at least one each, max_rows in total."""
+    strata = sorted(counts.keys(), key=lambda s: (-counts[s], s))
+    total = sum(counts.values())
+    # strata beyond max_rows (smallest first) get no rows at all
+    strata = strata[:max_rows]
+    allocation = dict((s, 1) for s in strata)
+    spare = max_rows - len(strata)
+    if spare <= 0:
+        return allocation
+
+    shares = dict((s, spare * counts[s] * 1.0 / total) for s in strata)
+    for s in strata:
+        allocation[s] = min(counts[s], 1 + int(shares[s]))
+
+    # hand out what rounding down left over, largest remainders first
+    left = max_rows - sum(allocation.values())
+    for s in sorted(strata, key=lambda s: -(shares[s] - int(shares[s]))):
+        if left <= 0:
+            break
+        if allocation[s] < counts[s]:
+            allocation[s] += 1
+            left -= 1
+    return allocation
+
+
+def stratified(documents, max_rows, stratum, seed=DEFAULT_SEED):
+    """{total, sampled, content, weights, strata} over the documents of one cursor pass."""
+    rng = random.Random(seed)
+    counts = {}
+    # per stratum, a max-heap (negated keys) of the max_rows smallest keys
+    kept = {}
+    for position, document in enumerate(documents):
+        s = stratum(document)
+        counts[s] = counts.get(s, 0) + 1
+        heap = kept.setdefault(s, [])
+        item = (-rng.random(), position, document)
+        if len(heap) < max_rows:
+            heapq.heappush(heap, item)
+        elif item > heap[0]:
+            heapq.heapreplace(heap, item)
+
+    total = sum(counts.values())
+    if total <= max_rows:
+        rows = sorted((item for heap in kept.values() for item in heap), key=lambda item: item[1])
+        return {
+            "total": total,
+            "sampled": False,
+            "content": [document for key, position, document in rows],
+            "weights": None,
+            "strata": {"counts": counts, "sampled": counts}
+        }
+
+    allocation = allocate(counts, max_rows)
+    rows = []
+    weights = {}
+    for s, n in allocation.items():
+        weights[s] = counts[s] * 1.0 / n
+        rows.extend((position, document, weights[s]) for key, position, document in heapq.nlargest(n, kept[s]))
+    rows.sort(key=lambda row: row[0])
+
+    return {
+        "total": total,
+        "sampled": True,
+        "content": [document for position, document, weight in rows],
+        "weights": [weight for position, document, weight in rows],
+        "strata": {
+            "counts": counts,
+            "sampled": dict((s, allocation.get(s, 0)) for s in counts),
+            "weights": weights
+        }
+    }
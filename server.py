@@ -0,0 +1,261 @@
+import os
+import sys
+import traceback
+
+## database and server
+from flask import Flask, Blueprint
+from flask import g, request, jsonify, abort, current_app
+
+import assets
+import capture
+import inflight
+import instrumentation
+import profiling
+import reads
+import responses
+from datasets import DatasetRegistry, load_config, merge_threshold, top_k, DEFAULT_CONFIG
+from instrumentation import stage, observe
+
+## Serves every dataset listed in datasets.json from one process.
+##
+## Each dataset is mounted under its own prefix (/flights/, /building/, ...). The
+## dashboards use relative URLs, so flights.html served from /flights/ talks to
+## /flights/order and /flights/data. app_flights.py and app_building.py run the same
+## routes for a single dataset mounted at the root.
+##
+##   python server.py [datasets.json]
+
+STATIC_FOLDER = "public"
+DEFAULT_MEMORY_BUDGET_MB = 2048
+DEFAULT_PORT = 3000
+
+## precompressed static files, served from memory
+static_assets = assets.AssetStore(os.path.join(os.path.dirname(os.path.abspath(__file__)), STATIC_FOLDER))
+
+shared_routes = Blueprint("shared", __name__)
+dataset_routes = Blueprint("dataset", __name__)
+
+
+def create_registry(config):
+    client = reads.shared_client(config.get("mongo_uri"), config.get("mongo_pool_size", reads.POOL_SIZE))
+    budget = config.get("memory_budget_mb", DEFAULT_MEMORY_BUDGET_MB) * 1024 * 1024
+    return DatasetRegistry(config["datasets"], client, budget, config.get("cache_dir", "input"))
+
+
+def create_app(registry, dataset=None, static_url_path=None):
+    """Every dataset of `registry` under /<name>/, or only `dataset` at the root."""
+    app = Flask(__name__, static_folder=STATIC_FOLDER, static_url_path=static_url_path)
+    instrumentation.init_app(app)
+    profiling.init_app(app)
+    capture.init_app(app)
+
+    app.extensions["datasets"] = registry
+    app.config["DATASET"] = dataset
+    if dataset is None:
+        app.register_blueprint(shared_routes)
+        app.register_blueprint(dataset_routes, url_prefix="/<dataset>")
+    else:
+        app.register_blueprint(dataset_routes)
+    return app
+
+
+def current_registry():
+    return current_app.extensions["datasets"]
+
+
+@dataset_routes.url_value_preprocessor
+def pull_dataset(endpoint, values):
+    g.dataset_name = values.pop("dataset", current_app.config["DATASET"])
+    if g.dataset_name not in current_registry():
+        abort(404)
+
+
+@dataset_routes.url_defaults
+def add_dataset(endpoint, values):
+    if current_app.url_map.is_endpoint_expecting(endpoint, "dataset"):
+        values.setdefault("dataset", g.dataset_name)
+
+
+def current_dataset():
+    with stage("load"):
+        return current_registry().get(g.dataset_name)
+
+
+## shared routes
+
+@shared_routes.route("/")
+def index():
+    return jsonify({"datasets": current_registry().status()})
+
+
+@shared_routes.route("/datasets")
+def dataset_status():
+    registry = current_registry()
+    return jsonify({"datasets": registry.status(), "memory_budget": registry.memory_budget})
+
+
+## per dataset routes
+
+@dataset_routes.route("/")
+def dataset_index():
+    page = current_registry().datasets[g.dataset_name].page
+    if page is None:
+        abort(404)
+    return static_assets.send(current_app, page)
+
+
+@dataset_routes.route('/js/<path:path>')
+def send_js(path):
+    return static_assets.send(current_app, 'js/' + path)
+
+
+@dataset_routes.route('/css/<path:path>')
+def send_css(path):
+    return static_assets.send(current_app, 'css/' + path)
+
+
+@dataset_routes.route('/images/<path:path>')
+def send_images(path):
+    return static_assets.send(current_app, 'images/' + path)
+
+
+## read query from client and return data
+## /data?max_rows=N[&stratify=column] samples results over N rows (see sampling.py)
+@dataset_routes.route("/data", methods=['POST'])
+def get_data():
+    raw_query = request.get_json()
+    max_rows = request.args.get("max_rows", type=int)
+    if max_rows is not None and max_rows < 1:
+        abort(400)
+
+    try:
+        if max_rows is not None:
+            returnData = current_dataset().sample_data_from_query(raw_query, max_rows, request.args.get("stratify"))
+            returnData["query"] = {}
+            observe("result_rows", returnData["total"])
+            observe("sampled_rows", len(returnData["content"]))
+            return responses.json_response(current_app, returnData)
+
+        # clients that read BSON get the stored documents passed through undecoded
+        if responses.accepts("application/bson"):
+            body = current_dataset().raw_data_from_query(raw_query)
+            return responses.body_response(current_app, body, "application/bson")
+
+        documents = current_dataset().retrieve_data_from_query(raw_query)
+        observe("result_rows", len(documents))
+        return responses.json_response(current_app, {"query": {}, "content": documents})
+
+    except Exception, e:
+        print "Error: Retrieving Data from MongoDB"
+        return jsonify({'error': str(e), 'trace': traceback.format_exc()})
+
+
+def coalesce(route, dataset, compute):
+    """compute(req) for this request, shared with identical ones; superseded ones get SUPERSEDED_STATUS."""
+    req = request.get_json()
+    key = inflight.request_key(g.dataset_name + route, dataset.current().version, req)
+    try:
+        returnData = dataset.inflight.run(key, inflight.view_key(g.dataset_name + route, req), lambda: compute(req))
+    except inflight.Superseded:
+        return responses.json_response(current_app, {"error": "superseded"}, inflight.SUPERSEDED_STATUS)
+    return responses.json_response(current_app, returnData, numeric=True)
+
+
+@dataset_routes.route("/distance", methods=['POST'])
+def calculate_distance():
+    dataset = current_dataset()
+    return coalesce("/distance", dataset, dataset.distances)
+
+
+@dataset_routes.route("/order", methods=['POST'])
+def group_order():
+    dataset = current_dataset()
+    if dataset.annotation_col is None:
+        abort(404)
+    try:
+        merge_threshold(request.get_json())
+        top_k(request.get_json())
+    except ValueError:
+        abort(400)
+
+    return coalesce("/order", dataset, dataset.group_order)
+
+
+@dataset_routes.route("/order/members", methods=['POST'])
+def group_members():
+    req = request.get_json()
+    members = current_dataset().member_store.get(req.get("session"), req.get("view"), req.get("group"), req.get("annotation"))
+    if members is None:
+        abort(404)
+
+    return responses.json_response(current_app, members, numeric=True)
+
+
+@dataset_routes.route("/neighbors", methods=['POST'])
+def find_neighbors():
+    try:
+        returnData = current_dataset().neighbors(request.get_json())
+    except ValueError:
+        abort(400)
+    if returnData is None:
+        abort(404)
+
+    return responses.json_response(current_app, returnData)
+
+
+@dataset_routes.route("/annotations/similar", methods=['POST'])
+def similar_annotations():
+    try:
+        returnData = current_dataset().similar_annotations(request.get_json())
+    except ValueError:
+        abort(400)
+    if returnData is None:
+        abort(404)
+
+    return responses.json_response(current_app, returnData)
+
+
+@dataset_routes.route("/viewport", methods=['POST'])
+def get_viewport():
+    returnData = current_dataset().viewport(request.get_json())
+    if returnData is None:
+        abort(404)
+
+    return responses.json_response(current_app, returnData)
+
+
+@dataset_routes.route("/timeline", methods=['POST'])
+def get_timeline():
+    try:
+        returnData = current_dataset().time_counts(request.get_json())
+    except ValueError:
+        abort(400)
+    if returnData is None:
+        abort(404)
+
+    return responses.json_response(current_app, returnData)
+
+
+@dataset_routes.route("/clusters", methods=['POST'])
+@dataset_routes.route("/annotation", methods=['POST'])
+def get_annotation():
+    try:
+        returnData = current_dataset().cluster_meta(request.get_json())
+        return responses.json_response(current_app, returnData)
+
+    except Exception, e:
+        print str(traceback.format_exc())
+        return jsonify({'error': str(e), 'trace': traceback.format_exc()})
+
+
+## run the server app
+if __name__ == "__main__":
+    config_path = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_CONFIG
+    config = load_config(config_path)
+    registry = create_registry(config)
+    app = create_app(registry)
+
+    for name in config.get("preload", []):
+        registry.get(name)
+
+    app.run(host='0.0.0.0', port=config.get("port", DEFAULT_PORT), debug=True, use_reloader=False, threaded=True)
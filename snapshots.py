@@ -0,0 +1,40 @@
+import itertools
+import threading
+
+## Immutable dataset snapshots.
+##
+## Everything a request reads from a loaded dataset (documents, feature matrix, column
+## metadata, annotation counts and the structures derived from them) lives in one Snapshot.
+## Handlers take the current snapshot once, read only from it and never write into it;
+## per-request values such as /order scores stay in local arrays. Reloading (see
+## Dataset.reload) builds a new snapshot and installs it with a single assignment, so
+## requests in flight keep a consistent view. Structures built on first use (neighbor
+## index, annotation members, ...) are attached to the snapshot they were built from
+## and go away with it.
+
+versions = itertools.count(1)
+
+
+class Snapshot(object):
+
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+        self.__dict__["version"] = next(versions)
+        self.__dict__["derived"] = {}
+        self.__dict__["lock"] = threading.Lock()
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Snapshot is read-only, build a new one instead")
+
+    def derive(self, name, build):
+        """build(snapshot), computed once per snapshot and cached under `name`."""
+        derived = self.derived.get(name)
+        if derived is None:
+            with self.lock:
+                if name not in self.derived:
+                    self.derived[name] = build(self)
+                derived = self.derived[name]
+        return derived
+
+    def derived_nbytes(self):
+        return sum(getattr(value, "nbytes", 0) for value in list(self.derived.values()))
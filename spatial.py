@@ -0,0 +1,133 @@
+import math
+
+import numpy as np
+
+## Spatial index and zoom-level cluster pyramid for map views.
+##
+## Points are projected to Web Mercator ([0, 1) on both axes) once at startup. For every
+## zoom level up to MAX_ZOOM the points are binned into cells of CELL_PIXELS screen
+## pixels, and each level keeps its non-empty cells sorted by column so a viewport is a
+## binary search plus a row filter. Levels stop being precomputed once they have nearly
+## one cell per point; deeper zooms and filtered views are answered from the points
+## themselves, which are kept sorted by x for the same binary search.
+
+TILE_PIXELS = 256
+CELL_PIXELS = 64
+MAX_ZOOM = 18
+# stop building levels once cells hold fewer than this many points on average
+MIN_POINTS_PER_CELL = 4
+MAX_POINTS = 2000
+
+
+def project(latitudes, longitudes):
+    latitudes = np.clip(latitudes, -85.05112878, 85.05112878)
+    x = (longitudes + 180.) / 360.
+    sin = np.sin(np.radians(latitudes))
+    y = 0.5 - np.log((1. + sin) / (1. - sin)) / (4. * math.pi)
+    return np.clip(x, 0., 1. - 1e-12), np.clip(y, 0., 1. - 1e-12)
+
+
+def cells_per_axis(zoom):
+    return (2 ** zoom) * TILE_PIXELS // CELL_PIXELS
+
+
+class Level(object):
+    """Non-empty cells of one zoom level, sorted by (column, row)."""
+
+    def __init__(self, zoom, x, y, latitudes, longitudes):
+        self.zoom = zoom
+        cells = cells_per_axis(zoom)
+        cx = (x * cells).astype(np.int64)
+        cy = (y * cells).astype(np.int64)
+        ids, inverse = np.unique(cx * cells + cy, return_inverse=True)
+
+        self.count = np.bincount(inverse, minlength=len(ids))
+        self.latitude = np.bincount(inverse, weights=latitudes, minlength=len(ids)) / self.count
+        self.longitude = np.bincount(inverse, weights=longitudes, minlength=len(ids)) / self.count
+        self.column = ids // cells
+        self.row = ids % cells
+
+    def __len__(self):
+        return len(self.count)
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for a in [self.count, self.latitude, self.longitude, self.column, self.row])
+
+    def clusters(self, x0, x1, y0, y1):
+        cells = cells_per_axis(self.zoom)
+        start = np.searchsorted(self.column, int(x0 * cells), side="left")
+        end = np.searchsorted(self.column, int(x1 * cells), side="right")
+        rows = self.row[start:end]
+        selected = np.arange(start, end)[(rows >= int(y0 * cells)) & (rows <= int(y1 * cells))]
+        return [{
+            "latitude": float(self.latitude[i]),
+            "longitude": float(self.longitude[i]),
+            "count": int(self.count[i])
+        } for i in selected]
+
+
+class SpatialIndex(object):
+
+    def __init__(self, documents, latitude="latitude", longitude="longitude"):
+        latitudes = np.array([d.get(latitude, np.nan) for d in documents], dtype=float)
+        longitudes = np.array([d.get(longitude, np.nan) for d in documents], dtype=float)
+        located = np.flatnonzero(~(np.isnan(latitudes) | np.isnan(longitudes)))
+
+        x, y = project(latitudes[located], longitudes[located])
+        order = np.argsort(x, kind="mergesort")
+        self.rows = located[order]
+        self.x = x[order]
+        self.y = y[order]
+        self.latitudes = latitudes[self.rows]
+        self.longitudes = longitudes[self.rows]
+
+        # row position of each document id, to turn filter results into a mask
+        self.positions = dict((d["_id"], i) for i, d in enumerate(documents) if "_id" in d)
+        self.size = len(documents)
+
+        self.levels = []
+        for zoom in range(0, MAX_ZOOM + 1):
+            level = Level(zoom, self.x, self.y, self.latitudes, self.longitudes)
+            if len(level) * MIN_POINTS_PER_CELL > len(self.rows):
+                break
+            self.levels.append(level)
+
+    @property
+    def nbytes(self):
+        arrays = [self.rows, self.x, self.y, self.latitudes, self.longitudes]
+        return sum(a.nbytes for a in arrays) + sum(level.nbytes for level in self.levels)
+
+    def mask(self, ids):
+        mask = np.zeros(self.size, dtype=bool)
+        mask[[self.positions[i] for i in ids if i in self.positions]] = True
+        return mask
+
+    def viewport(self, bounds, zoom, mask=None):
+        """Clusters (or points, when few enough) inside [south, west, north, east]."""
+        south, west, north, east = bounds
+        x0, y1 = project(np.array([south]), np.array([west]))
+        x1, y0 = project(np.array([north]), np.array([east]))
+        x0, x1, y0, y1 = float(x0[0]), float(x1[0]), float(y0[0]), float(y1[0])
+        zoom = max(0, min(int(zoom), MAX_ZOOM))
+
+        if mask is None and zoom < len(self.levels):
+            return {"zoom": zoom, "clusters": self.levels[zoom].clusters(x0, x1, y0, y1), "points": []}
+
+        start = np.searchsorted(self.x, x0, side="left")
+        end = np.searchsorted(self.x, x1, side="right")
+        candidates = np.arange(start, end)
+        candidates = candidates[(self.y[start:end] >= y0) & (self.y[start:end] <= y1)]
+        if mask is not None:
+            candidates = candidates[mask[self.rows[candidates]]]
+
+        if len(candidates) <= MAX_POINTS or zoom == MAX_ZOOM:
+            points = [{
+                "index": int(self.rows[i]),
+                "latitude": float(self.latitudes[i]),
+                "longitude": float(self.longitudes[i])
+            } for i in candidates[:MAX_POINTS]]
+            return {"zoom": zoom, "clusters": [], "points": points, "total": len(candidates)}
+
+        level = Level(zoom, self.x[candidates], self.y[candidates], self.latitudes[candidates], self.longitudes[candidates])
+        return {"zoom": zoom, "clusters": level.clusters(x0, x1, y0, y1), "points": []}
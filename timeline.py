@@ -0,0 +1,263 @@
+import threading
+import time
+from collections import OrderedDict
+from datetime import date, datetime
+
+import numpy as np
+
+## Pre-aggregated timeline counts.
+##
+## Documents are counted per day, week (starting Monday), month and year into dense
+## arrays that cover the dates seen so far, overall and split by the values of a few
+## categorical columns. Each level keeps prefix sums, so the total of a date range is two
+## lookups and its buckets are one slice: O(buckets), independent of the number of
+## documents. Ranges are rounded out to whole buckets. New documents are added into the
+## existing arrays (which grow at either end when needed); prefix sums are rebuilt
+## lazily on the next query.
+
+GRANULARITIES = ["day", "week", "month", "year"]
+# finest granularity picked automatically is the first with at most this many buckets
+MAX_BUCKETS = 400
+DATE_FORMATS = ['%Y-%m-%dT%H:%M:%S.%fZ', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d']
+PARSED_DATES = 4096
+REFRESH_SECONDS = 5.
+EMPTY_DATUM = "None"
+
+parsed_dates = {}
+
+
+def parse_date(text):
+    """datetime of an ISO string sent by the client, memoized across queries."""
+    if isinstance(text, datetime):
+        return text
+
+    parsed = parsed_dates.get(text)
+    if parsed is None:
+        for pattern in DATE_FORMATS:
+            try:
+                parsed = datetime.strptime(text, pattern)
+                break
+            except ValueError:
+                continue
+        if parsed is None:
+            raise ValueError("Unrecognized date " + text)
+
+        if len(parsed_dates) >= PARSED_DATES:
+            parsed_dates.clear()
+        parsed_dates[text] = parsed
+    return parsed
+
+
+def bucket_keys(ordinals, years, months, granularity):
+    """Bucket number of each date; works on scalars and numpy arrays."""
+    if granularity == "day":
+        return ordinals
+    if granularity == "week":
+        # ordinal 1 (0001-01-01) is a Monday
+        return (ordinals - 1) // 7
+    if granularity == "month":
+        return years * 12 + months - 1
+    return years
+
+
+def bucket_key(moment, granularity):
+    return bucket_keys(moment.toordinal(), moment.year, moment.month, granularity)
+
+
+def bucket_start(key, granularity):
+    if granularity == "day":
+        return date.fromordinal(key)
+    if granularity == "week":
+        return date.fromordinal(key * 7 + 1)
+    if granularity == "month":
+        return date(key // 12, key % 12 + 1, 1)
+    return date(key, 1, 1)
+
+
+class Level(object):
+    """Dense counts of one granularity; series None is the total, (col, value) a split."""
+
+    def __init__(self, granularity):
+        self.granularity = granularity
+        self.origin = None
+        self.length = 0
+        self.series = {}
+        self.prefix = {}
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for a in self.series.values()) + sum(a.nbytes for a in self.prefix.values())
+
+    def grow(self, low, high):
+        if self.origin is None:
+            self.origin = low
+            self.length = 0
+
+        before = max(0, self.origin - low)
+        after = max(0, high - (self.origin + self.length - 1))
+        if before == 0 and after == 0:
+            return
+
+        for name, counts in self.series.items():
+            self.series[name] = np.concatenate([
+                np.zeros(before, dtype=np.int64), counts, np.zeros(after, dtype=np.int64)])
+        self.origin -= before
+        self.length += before + after
+
+    def add(self, name, keys):
+        if name not in self.series:
+            self.series[name] = np.zeros(self.length, dtype=np.int64)
+        self.series[name] += np.bincount(keys - self.origin, minlength=self.length)
+        self.prefix.pop(name, None)
+
+    def cumulative(self, name):
+        if name not in self.prefix:
+            self.prefix[name] = np.concatenate([[0], np.cumsum(self.series[name])])
+        return self.prefix[name]
+
+    def window(self, name, first, last):
+        """Counts of buckets first..last (positions, inclusive) and their total."""
+        if name not in self.series:
+            return [0] * (last - first + 1), 0
+        prefix = self.cumulative(name)
+        counts = [int(c) for c in self.series[name][first:last + 1]]
+        return counts, int(prefix[last + 1] - prefix[first])
+
+
+class TimePyramid(object):
+
+    def __init__(self, documents=(), date="date", splits=()):
+        self.date = date
+        self.splits = list(splits)
+        self.lock = threading.Lock()
+        # held by the one request that is fetching new documents
+        self.refreshing = threading.Lock()
+        self.reset()
+        self.add(documents)
+
+    def reset(self):
+        self.levels = OrderedDict((granularity, Level(granularity)) for granularity in GRANULARITIES)
+        self.values = dict((col, set()) for col in self.splits)
+        self.total = 0
+        self.first_id = None
+        self.last_id = None
+        self.refreshed = time.time()
+
+    @property
+    def nbytes(self):
+        return sum(level.nbytes for level in self.levels.values())
+
+    def add(self, documents):
+        """Counts new documents into every level."""
+        documents = [d for d in documents if isinstance(d.get(self.date), datetime)]
+        if len(documents) == 0:
+            return
+
+        moments = [d[self.date] for d in documents]
+        ordinals = np.array([m.toordinal() for m in moments], dtype=np.int64)
+        years = np.array([m.year for m in moments], dtype=np.int64)
+        months = np.array([m.month for m in moments], dtype=np.int64)
+
+        splits = {}
+        for col in self.splits:
+            values, inverse = np.unique([unicode(d.get(col, EMPTY_DATUM)) for d in documents], return_inverse=True)
+            order = np.argsort(inverse, kind="mergesort")
+            bounds = np.searchsorted(inverse[order], np.arange(len(values) + 1))
+            splits[col] = [(unicode(values[i]), order[bounds[i]:bounds[i + 1]]) for i in range(0, len(values))]
+
+        ids = [d["_id"] for d in documents if "_id" in d]
+
+        with self.lock:
+            for granularity, level in self.levels.items():
+                keys = bucket_keys(ordinals, years, months, granularity)
+                level.grow(int(keys.min()), int(keys.max()))
+                level.add(None, keys)
+                for col, groups in splits.items():
+                    for value, rows in groups:
+                        level.add((col, value), keys[rows])
+
+            for col, groups in splits.items():
+                self.values[col].update(value for value, rows in groups)
+            self.total += len(documents)
+            if len(ids) > 0:
+                if self.first_id is None:
+                    self.first_id = min(ids)
+                self.last_id = max(ids) if self.last_id is None else max(self.last_id, max(ids))
+
+    def refresh(self, collection):
+        """Adds documents inserted since the last refresh, at most every REFRESH_SECONDS.
+
+        Relies on ObjectIds increasing with insertion. A collection that was dropped and
+        reloaded (the first counted document is gone) is counted again from scratch.
+        """
+        if time.time() - self.refreshed < REFRESH_SECONDS:
+            return 0
+        if not self.refreshing.acquire(False):
+            return 0
+        try:
+            self.refreshed = time.time()
+            return self.fetch(collection)
+        finally:
+            self.refreshing.release()
+
+    def fetch(self, collection):
+        projection = dict((col, True) for col in [self.date] + self.splits)
+        query = {}
+        if self.first_id is not None:
+            if collection.find_one({"_id": self.first_id}, {"_id": True}) is None:
+                with self.lock:
+                    self.reset()
+            else:
+                query = {"_id": {"$gt": self.last_id}}
+
+        documents = list(collection.find(query, projection))
+        self.add(documents)
+        return len(documents)
+
+    def granularity_for(self, start, end):
+        for granularity in GRANULARITIES:
+            level = self.levels[granularity]
+            if level.origin is None:
+                # nothing counted yet, any granularity gives the same empty series
+                return granularity
+            first = level.origin if start is None else bucket_key(start, granularity)
+            last = level.origin + level.length - 1 if end is None else bucket_key(end, granularity)
+            if last - first + 1 <= MAX_BUCKETS:
+                return granularity
+        return GRANULARITIES[-1]
+
+    def query(self, granularity=None, start=None, end=None, split=None, values=None):
+        """Bucketed counts between start and end (inclusive), optionally per split value."""
+        start = None if start is None else parse_date(start)
+        end = None if end is None else parse_date(end)
+        if granularity is None:
+            granularity = self.granularity_for(start, end)
+        if granularity not in self.levels:
+            raise ValueError("Unknown granularity " + str(granularity))
+        if split is not None and split not in self.values:
+            raise ValueError("Timeline is not split by " + str(split))
+
+        result = {"granularity": granularity, "buckets": [], "counts": [], "total": 0}
+        if split is not None:
+            result["series"] = {}
+        with self.lock:
+            level = self.levels[granularity]
+            if level.origin is None:
+                return result
+
+            first = 0 if start is None else max(0, bucket_key(start, granularity) - level.origin)
+            last = level.length - 1 if end is None else min(level.length - 1, bucket_key(end, granularity) - level.origin)
+            if last < first:
+                return result
+
+            result["buckets"] = [bucket_start(level.origin + i, granularity).isoformat() for i in range(first, last + 1)]
+            result["counts"], result["total"] = level.window(None, first, last)
+
+            if split is not None:
+                series = {}
+                for value in sorted(self.values[split]) if values is None else values:
+                    counts, total = level.window((split, value), first, last)
+                    series[value] = {"counts": counts, "total": total}
+                result["series"] = series
+
+        return result
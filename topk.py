@@ -0,0 +1,139 @@
+import json
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+## Bounded /order responses.
+##
+## With `top_k` set, every group/annotation pair is reduced to its k most outlying and
+## k most central points plus summary statistics of its scores (count, mean and the
+## QUANTILES, min to max). Large pairs are reduced with np.argpartition rather than a
+## full sort. The full member lists are kept per session and view and served by group
+## id from /order/members, so the /order payload no longer grows with the brush.
+
+QUANTILES = [0, 25, 50, 75, 100]
+MAX_SESSIONS = 64
+MAX_K = 1000
+# below this many scores one sort is cheaper than partitioning and np.percentile
+SMALL_GROUP = 256
+
+
+def parse_k(value):
+    """`value` as a top_k in [0, MAX_K]; raises ValueError for anything else."""
+    if isinstance(value, (bool, float)):
+        raise ValueError("top_k must be an integer")
+    try:
+        k = int(value)
+    except TypeError:
+        raise ValueError("top_k must be an integer")
+    if not 0 <= k <= MAX_K:
+        raise ValueError("top_k must be between 0 and " + str(MAX_K))
+    return k
+
+
+def point(indices, scores, i):
+    return {"index": indices[i], "score": scores[i]}
+
+
+def extremes(indices, scores, k):
+    """Returns the k highest scoring and the k lowest scoring points, most extreme first."""
+    n = len(scores)
+    k = min(k, n)
+    if n <= SMALL_GROUP:
+        order = sorted(range(0, n), key=lambda i: scores[i])
+        top = order[::-1][:k]
+        bottom = order[:k]
+    else:
+        values = np.asarray(scores, dtype=float)
+        top = np.argpartition(-values, k - 1)[:k]
+        bottom = np.argpartition(values, k - 1)[:k]
+        top = [int(i) for i in top[np.argsort(-values[top], kind="mergesort")]]
+        bottom = [int(i) for i in bottom[np.argsort(values[bottom], kind="mergesort")]]
+
+    return [point(indices, scores, i) for i in top], [point(indices, scores, i) for i in bottom]
+
+
+def summarize(scores):
+    n = len(scores)
+    if n == 0:
+        return {"count": 0}
+
+    if n <= SMALL_GROUP:
+        ordered = sorted(scores)
+        quantiles = []
+        for q in QUANTILES:
+            # linear interpolation, same as np.percentile's default
+            position = (n - 1) * q / 100.
+            low = int(position)
+            high = min(low + 1, n - 1)
+            quantiles.append(ordered[low] + (ordered[high] - ordered[low]) * (position - low))
+        mean = sum(scores) / float(n)
+    else:
+        values = np.asarray(scores, dtype=float)
+        quantiles = [float(v) for v in np.percentile(values, QUANTILES)]
+        mean = float(values.mean())
+
+    return {"count": n, "mean": mean, "quantiles": quantiles}
+
+
+def compact_groups(groups, k):
+    """Splits full /order groups into a bounded summary and the member lists by group id."""
+    compact = []
+    members = {}
+    for group in groups:
+        group_members = {"indices": group["indices"], "annotations": {}}
+        annotations = []
+        for annotation in group["annotations"]:
+            outliers, central = extremes(annotation["indices"], annotation["scores"], k)
+            summary = dict((key, value) for key, value in annotation.items() if key not in ["indices", "scores"])
+            summary["outliers"] = outliers
+            summary["central"] = central
+            summary["summary"] = summarize(annotation["scores"])
+            annotations.append(summary)
+            group_members["annotations"][annotation["annotation"]] = {
+                "indices": annotation["indices"],
+                "scores": annotation["scores"]
+            }
+
+        compact.append({
+            "id": group["id"],
+            "key": group["key"],
+            "count": group["count"],
+            "annotations": annotations
+        })
+        members[group["id"]] = group_members
+
+    return compact, members
+
+
+class MemberStore(object):
+    """Full member lists of the last top-k /order response of each view of a session."""
+
+    def __init__(self, max_sessions=MAX_SESSIONS):
+        self.max_sessions = max_sessions
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+
+    def key(self, session, view):
+        # the charts of one dashboard share a session and tell their requests apart by view
+        return session, json.dumps(view, sort_keys=True)
+
+    def put(self, session, view, members):
+        key = self.key(session, view)
+        with self.lock:
+            self.sessions.pop(key, None)
+            self.sessions[key] = members
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+
+    def get(self, session, view, group, annotation=None):
+        with self.lock:
+            members = self.sessions.get(self.key(session, view), {}).get(group)
+        if members is None or annotation is None:
+            return members
+        return members["annotations"].get(annotation)
+
+    def clear(self):
+        with self.lock:
+            self.sessions.clear()